@@ -4,40 +4,53 @@
 
 #EXAMPLE: 
 #   cd analysis/data
-#   python3 DataloggerDecoder.py -i datalogger_fsgp2022_day1/raw -o datalogger_fsgp2022_day1/decoded
+#   python3 DataloggerDecoder.py -i datalogger_fsgp2022_day1/raw -o datalogger_fsgp2022_day1/decoded --jobs 8
+#   python3 DataloggerDecoder.py -i /media/sdcard --follow -s 0x703 0x702    (watch the newest log while it's written)
+#   python3 DataloggerDecoder.py -i datalogger_fsgp2022_day1/raw -o datalogger_fsgp2022_day1/bin --convert    (compact binary logs, see convert_log)
+#   python3 DataloggerDecoder.py -i datalogger_fsgp2022_day1/raw -d telemetry.db --jobs 8    (sqlite database, see open_database)
 
 import numpy as np
-import csv
+import os
+import io
+import re
 import json
 import glob
+import time
+import zipfile
+import hashlib
+import sqlite3
+from itertools import repeat
+from contextlib import ExitStack
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import argparse
 from datetime import datetime
 import pandas as pd
 
+DECODER_VERSION = 3     #bump when a change to the decoder changes its output, so decode_folder decodes every log again
+MANIFEST = "manifest.json"
+
+#binary raw logs (see convert_log): a header, then fixed width records with the payload right aligned like hex_to_bytes
+BINARY_MAGIC = b"ISCLOG01"
+BINARY_HEADER = np.dtype([("magic", "S8"), ("start_millis", "<i8")])
+BINARY_RECORD = np.dtype([("millis", "<u4"), ("id", "<u2"), ("len", "u1"), ("data", "u1", (8,))])
+
 data_types = {
-    "FloatLE": {"type": "float", "byteLen": 4, "fstring": ">f"},
-    "Uint16LE": {"type": "int", "byteLen": 2, "isSigned": False, "fstring": ">u2"},
-    "Int16LE": {"type": "int", "byteLen": 2, "isSigned": True, "fstring": ">i2"},
-    "Uint32LE": {"type": "int", "byteLen": 4, "isSigned": False, "fstring": ">u4"},
-    "Int32LE": {"type": "int", "byteLen": 4, "isSigned": True, "fstring": ">i4"},
-    "Uint64LE": {"type": "int", "byteLen": 8, "isSigned": False, "fstring": ">u8"},
-    "Int64LE": {"type": "int", "byteLen": 8, "isSigned": True, "fstring": ">i8"},
-    "Uint8LE": {"type": "int", "byteLen": 1, "isSigned": False, "fstring": "B"},
+    "FloatLE": {"type": "float", "byteLen": 4, "fstring": "<f4"},
+    "Uint16LE": {"type": "int", "byteLen": 2, "isSigned": False, "fstring": "<u2"},
+    "Int16LE": {"type": "int", "byteLen": 2, "isSigned": True, "fstring": "<i2"},
+    "Uint32LE": {"type": "int", "byteLen": 4, "isSigned": False, "fstring": "<u4"},
+    "Int32LE": {"type": "int", "byteLen": 4, "isSigned": True, "fstring": "<i4"},
+    "Uint64LE": {"type": "int", "byteLen": 8, "isSigned": False, "fstring": "<u8"},
+    "Int64LE": {"type": "int", "byteLen": 8, "isSigned": True, "fstring": "<i8"},
+    "Uint8LE": {"type": "int", "byteLen": 1, "isSigned": False, "fstring": "u1"},
 
     "BitMap8LE": {"type": "bitmap", "byteLen":1},
     "BitMap16LE": {"type": "bitmap", "byteLen":2},
     "BitMap32LE": {"type": "bitmap", "byteLen":4}
 }
 
-def decode_bitmap(data, length):
-    def access_bit(data, num):
-        base = int(num // 8)
-        shift = int(num % 8)
-        return (data[base] & (1<<shift)) >> shift
-    
-    return [access_bit(data, i) for i in range(length * 8)]
-
 def get_message_len(can_id, canDef):
     can_struct = canDef[can_id]
     if isinstance(can_struct["DataFormat"], list):
@@ -48,116 +61,819 @@ def get_message_len(can_id, canDef):
         l = (data_types[can_struct["DataFormat"]]["byteLen"] * can_struct["DataQty"])
     return l
 
-def decode_array(hexString, can_id, canDef, dformat, dquantity):
-    l = get_message_len(can_id, canDef)
-    byte_array = bytes.fromhex(hexString)[-l:]
-    cur_index = 0
-    ret = []
-    for i in range(dquantity):
-        if isinstance(dformat, list):
-            this_format = dformat[i]
+def decode_array(hexString, can_id, canDef, dformat=None, dquantity=None):
+    '''Decode a single message. Returns its values in the order of parsedValue (see decode)'''
+    plan = compile_plan(can_id, canDef)
+    payloads, lens = hex_to_bytes(np.array([hexString]))
+    if lens[0] < plan["length"]:
+        raise ValueError(f"payload {hexString} is too short for id {can_id}")
+    values = decode_payloads(payloads, plan)
+    return [v[0].tolist() for v in reversed(values)]
+        
+def read_header(fp):
+    '''Read the header lines of a raw log from an open file. Returns the start time of the log in millis'''
+    next(fp) #Mount
+    next(fp) #RTC Time Good
+    
+    time_row = next(fp)
+    start_millis = datetime.strptime(time_row[-20:-1], '%Y-%m-%d %H:%M:%S').timestamp() * 1000
+    print(f"start millis: {start_millis}")
+
+    next(fp) #SD mount time
+    return start_millis
+
+def clean_log(log, start_millis):
+    '''Drop lines that aren't messages, like "Lost power, eject at (millis): ..." at the end of a log, and convert millis to unix millis'''
+    millis = pd.to_numeric(log["millis"], errors='coerce')
+    log = log[millis.notna()].copy()
+    log["millis"] = millis[millis.notna()].astype(np.int64) + int(start_millis)
+    return log.reset_index(drop=True)
+
+def iter_log(file, chunk_size=100000):
+    '''Read a raw datalogger log in chunks of chunk_size lines. Yields DataFrames with millis, id and data (hex) columns'''
+    with open(file) as fp:
+        start_millis = read_header(fp)
+        for chunk in pd.read_csv(fp, dtype=str, keep_default_na=False, on_bad_lines='skip', chunksize=chunk_size):
+            yield clean_log(chunk, start_millis)
+
+def read_log(file):
+    '''Read a whole raw datalogger log. Returns the start time (millis) and a DataFrame with millis, id and data (hex) columns'''
+    with open(file) as fp:
+        start_millis = read_header(fp)
+        log = pd.read_csv(fp, dtype=str, keep_default_na=False, on_bad_lines='skip')
+    return start_millis, clean_log(log, start_millis)
+
+HEX_DIGITS = np.full(256, 255, dtype=np.uint8)    #ascii code -> value of hex digit, 255 if not a hex digit
+HEX_DIGITS[0] = 0                                   #padding after short strings
+for i, c in enumerate('0123456789abcdef'):
+    HEX_DIGITS[ord(c)] = i
+    HEX_DIGITS[ord(c.upper())] = i
+
+def hex_to_bytes(hex_strings):
+    '''
+    Convert an array of hex strings into a uint8 matrix with one row per string. Bytes are right aligned,
+    so payload[-l:] is the same as bytes.fromhex(hex)[-l:]. Returns the matrix and the number of bytes in each row,
+    which is -1 for strings that aren't valid hex.
+    '''
+    chars = np.asarray(hex_strings).astype(bytes)
+    width = max(chars.dtype.itemsize + chars.dtype.itemsize % 2, 2)
+    chars = chars.astype(f"S{width}").view(np.uint8).reshape(-1, width)    #padded on the right with 0s
+    digits = HEX_DIGITS[chars]
+    invalid = (digits == 255).any(axis=1)
+
+    #right align the few strings that are shorter than the longest one
+    lens = np.full(len(chars), width)
+    short = np.flatnonzero(chars[:, -1] == 0)
+    lens[short] = np.count_nonzero(chars[short], axis=1)
+    for l in np.unique(lens[short]):
+        rows = short[lens[short] == l]
+        digits[rows, width-l:] = digits[rows, :l]
+        digits[rows, :width-l] = 0
+
+    payloads = (digits[:, 0::2] << 4) | digits[:, 1::2]
+    return payloads, np.where(invalid | (lens % 2 == 1), -1, lens // 2)
+
+def slugify(name):
+    return re.sub(r'[^a-z0-9]+', '_', str(name).lower()).strip('_')
+
+def value_names(can_id, canDef):
+    '''
+    Names of the values of a CAN id in canDef order, from its ValueNames made lowercase with underscores (eg. "bus_current_drawn_by_mc").
+    Values without a usable name (missing, empty or repeated) are named by their index.
+    '''
+    can_struct = canDef[can_id]
+    qty = can_struct["DataQty"]
+    names = can_struct.get("ValueNames") or []
+    if isinstance(names, str):
+        names = [names]
+    if len(names) != qty:
+        names = []
+
+    slugs = [slugify(name) for name in names]
+    slugs += [''] * (qty - len(slugs))
+    usable = lambda slug: slug and slugs.count(slug) == 1 and slug not in ("millis", "names")
+    return [slug if usable(slug) else str(i) for i, slug in enumerate(slugs)]
+
+def bit_names(can_id, canDef):
+    '''
+    Names of the bits of each bitmap value of a CAN id, from its Units: a list of bit names per bitmap, or one list shared
+    by all of them. Units list bits from the most significant one, so the last name is bit 0.
+    Returns a list with a dict of bit -> name (like value_names) for each value, empty for values that aren't named bitmaps.
+    '''
+    can_struct = canDef[can_id]
+    qty = can_struct["DataQty"]
+    formats = can_struct["DataFormat"]
+    if not isinstance(formats, list):
+        formats = [formats] * qty
+    units = can_struct.get("Units")
+    if not isinstance(units, list):
+        units = []
+
+    names = []
+    for i, this_format in enumerate(formats[:qty]):
+        bits = {}
+        if data_types[this_format]["type"] == "bitmap":
+            if len(units) == qty and isinstance(units[i], list):
+                bit_units = units[i]
+            elif len(units) > qty and all(isinstance(unit, str) for unit in units):
+                bit_units = units
+            else:
+                bit_units = []
+            slugs = [slugify(unit) for unit in reversed(bit_units)][:data_types[this_format]["byteLen"] * 8]
+            bits = {bit: slug for bit, slug in enumerate(slugs) if slug and slugs.count(slug) == 1}
+        names.append(bits)
+    return names
+
+def compile_plan(can_id, canDef):
+    '''
+    Work out once how to decode messages of a CAN id, so decoding them is just a lookup of this plan. Returns a dict with the
+    message "length" in bytes, a structured "dtype" over the CAN frame with a field "v{i}" for each value, and lists with
+    each value's byte "offsets", "names" (see value_names), "bit_names" (see bit_names), "kinds" (int, float or bitmap),
+    "casts" (dtype it's widened to) and "multipliers".
+    '''
+    can_struct = canDef[can_id]
+    qty = can_struct["DataQty"]
+    formats = can_struct["DataFormat"]
+    if not isinstance(formats, list):
+        formats = [formats] * qty
+    formats = [data_types[f] for f in formats[:qty]]
+
+    length = get_message_len(can_id, canDef)
+    offsets = np.cumsum([0] + [f["byteLen"] for f in formats])[:-1]
+    fields = [f["fstring"] if f["type"] != "bitmap" else ("u1", (f["byteLen"],)) for f in formats]
+    dtype = np.dtype({"names": [f"v{i}" for i in range(qty)], "formats": fields, "offsets": offsets, "itemsize": length})
+
+    multipliers = [1] * qty
+    if "Multiplier" in can_struct and can_id != '0x5E4':    #0x5E4 has never been scaled
+        if isinstance(can_struct["Multiplier"], list):
+            multipliers = can_struct["Multiplier"][:qty] + multipliers[len(can_struct["Multiplier"]):]
         else:
-            this_format = dformat
-        dtype = data_types[this_format]
-        b = byte_array[cur_index:cur_index + dtype["byteLen"]]
-        if(dtype["type"] == "int"):
-            ret.append(int(np.ndarray(shape=(1,),dtype=dtype["fstring"], buffer=b)[0]))
-        elif(dtype["type"] == "float"):
-            ret.append(float(np.ndarray(shape=(1,),dtype=dtype["fstring"], buffer=b)[0]))
+            multipliers = [can_struct["Multiplier"]] * qty
+
+    kinds = [f["type"] for f in formats]
+    casts = [np.dtype(np.uint64 if f.get("fstring") == "<u8" else np.int64) if f["type"] == "int"
+             else np.dtype(np.float64) if f["type"] == "float" else None for f in formats]
+    return {
+        "length": length,
+        "dtype": dtype,
+        "offsets": offsets,
+        "names": value_names(can_id, canDef),
+        "bit_names": bit_names(can_id, canDef),
+        "kinds": kinds,
+        "casts": casts,
+        "multipliers": [1 if kind == "bitmap" else m for kind, m in zip(kinds, multipliers)],
+    }
+
+def compile_can_def(canDef):
+    '''Compile the decode plan (see compile_plan) of every CAN id in canDef. Do this once and pass the plans to the decode functions'''
+    return {can_id: compile_plan(can_id, canDef) for can_id in canDef}
+
+def decode_payloads(payloads, plan):
+    '''
+    Decode the payloads (right aligned uint8 matrix from hex_to_bytes) of many messages with the same CAN id at once, using its plan from compile_plan.
+    Returns a list with an array of each value of the message in canDef order. Bitmaps are (messages, bits) uint8 arrays
+    of 0s and 1s, with bit 0 (the least significant) first.
+    '''
+    #the datalogger writes payloads as big endian 64 bit numbers, which reverses the bytes of the CAN frame.
+    #flip them back, then view the frames as a structured array with a little endian field for each value
+    frames = np.ascontiguousarray(payloads[:, ::-1][:, :plan["length"]])
+    records = frames.view(plan["dtype"]).reshape(-1)
+    if "bitmap" in plan["kinds"]:
+        bits = np.unpackbits(frames, axis=1, bitorder='little')     #bit j of byte i of the frame is bits[:, 8*i + j]
+
+    values = []
+    for i, (kind, cast, multiplier) in enumerate(zip(plan["kinds"], plan["casts"], plan["multipliers"])):
+        if kind == "bitmap":
+            start = plan["offsets"][i] * 8
+            values.append(bits[:, start:start + plan["dtype"][f"v{i}"].itemsize * 8])
         else:
-            ret.append(decode_bitmap(b, dtype["byteLen"]))
-        
-        cur_index += dtype["byteLen"]
-    return ret
-        
+            values.append(records[f"v{i}"].astype(cast) * multiplier)
+    return values
+
+def decode_messages(ids, hex_strings, plans, skipped=None):
+    '''
+    Decode arrays of CAN ids and hex payloads, grouping messages by id so each id is decoded in one batch with its plan.
+    Returns a dict of CAN id -> (row indices into the inputs, list of value arrays from decode_payloads).
+    Messages with unknown ids or payloads too short for their id are skipped, and counted in the Counter skipped
+    by (CAN id, reason) if it's given.
+    '''
+    payloads, lens = hex_to_bytes(hex_strings)
+    codes, unique_ids = pd.factorize(np.asarray(ids))
+    return decode_frames(codes, unique_ids, payloads, lens, plans, skipped)
+
+def decode_frames(codes, unique_ids, payloads, lens, plans, skipped=None):
+    '''decode_messages for payloads that are already bytes (see hex_to_bytes), with ids factorized into unique_ids[codes]'''
+    skipped = Counter() if skipped is None else skipped
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(unique_ids))
+    starts = np.cumsum(counts) - counts
+
+    decoded = {}
+    for code, can_id in enumerate(unique_ids):
+        rows = order[starts[code]:starts[code] + counts[code]]
+        plan = plans.get(can_id)
+        if plan is None:
+            skipped[(can_id, "unknown id")] += len(rows)
+            continue
+
+        bad = lens[rows] < plan["length"]
+        if bad.any():
+            skipped[(can_id, f"shorter than {plan['length']} bytes")] += int(np.count_nonzero(bad))
+            rows = rows[~bad]
+        if len(rows) == 0:
+            continue
+
+        decoded[can_id] = (rows, decode_payloads(payloads[rows], plan))
+    return decoded
+
+def print_skipped(skipped, name=""):
+    '''Print the messages counted as skipped by decode_messages, one line per CAN id and reason'''
+    for (can_id, reason), count in sorted(skipped.items()):
+        print(f"{name}skipped {count} messages with id {can_id}: {reason}")
+
+def decode_table(log, plans, skipped=None):
+    '''
+    Decode a log DataFrame from read_log or iter_log into a DataFrame with columns millis, id, hexString, length and parsedValue.
+    parsedValue lists the values of each message in reverse canDef order, the order they appear in the hex payload.
+    '''
+    decoded = decode_messages(log["id"].to_numpy(), log["data"].to_numpy(), plans, skipped)
+
+    rows = []
+    parsed_values = []
+    for can_id, (id_rows, values) in decoded.items():
+        rows.append(id_rows)
+        parsed_values.extend(list(map(list, zip(*[v.tolist() for v in reversed(values)]))))
+    rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+
+    messages = pd.DataFrame({
+        "millis": log["millis"].to_numpy()[rows],
+        "id": log["id"].to_numpy()[rows],
+        "hexString": log["data"].to_numpy()[rows],
+        "length": [len(v) for v in parsed_values],
+        "parsedValue": parsed_values,
+    }, index=rows)
+    return messages.sort_index().reset_index(drop=True)
+
+def decode_columns(log, plans, skipped=None):
+    '''
+    Decode a log DataFrame from read_log or iter_log into typed columns. Returns a dict with "{id}.millis" (int64) for every
+    CAN id in the log, and "{id}.{name}" for each of its values, named by value_names. "{id}.names" lists the value names in canDef order.
+    Named bits of bitmaps (see bit_names) also get a boolean column "{id}.{name}.{bit name}", eg. "0x701.error_flags.watchdog_reset".
+    '''
+    decoded = decode_messages(log["id"].to_numpy(), log["data"].to_numpy(), plans, skipped)
+    return make_columns(log["millis"].to_numpy(), decoded, plans)
+
+def make_columns(millis, decoded, plans):
+    columns = {}
+    for can_id, (rows, values) in decoded.items():
+        names = plans[can_id]["names"]
+        columns[f"{can_id}.millis"] = millis[rows]
+        columns[f"{can_id}.names"] = np.array(names)
+        for name, value, bits in zip(names, values, plans[can_id]["bit_names"]):
+            columns[f"{can_id}.{name}"] = value
+            for bit, bit_name in bits.items():
+                columns[f"{can_id}.{name}.{bit_name}"] = value[:, bit].astype(bool)
+    return columns
+
+def records_from_log(log, start_millis):
+    '''Convert a log DataFrame from read_log or iter_log to BINARY_RECORDs. Returns the records and the number of messages that don't fit in one'''
+    payloads, lens = hex_to_bytes(log["data"].to_numpy())
+    codes, unique_ids = pd.factorize(log["id"].to_numpy())
+    id_values = np.array([int(can_id, 16) if re.fullmatch(r"0x[0-9a-fA-F]{1,4}", can_id) else -1 for can_id in unique_ids] + [-1])
+    ids = id_values[codes]
+    millis = log["millis"].to_numpy() - int(start_millis)
+    fits = (ids >= 0) & (lens >= 0) & (lens <= 8) & (millis >= 0) & (millis < 2**32)
+
+    records = np.zeros(np.count_nonzero(fits), dtype=BINARY_RECORD)
+    records["millis"] = millis[fits]
+    records["id"] = ids[fits]
+    records["len"] = lens[fits]
+    width = min(payloads.shape[1], 8)
+    records["data"][:, 8-width:] = payloads[fits][:, payloads.shape[1]-width:]
+    return records, len(log) - len(records)
+
+def convert_log(file, out_file, chunk_size=100000):
+    '''
+    Convert a raw csv log to a binary log: a BINARY_HEADER with the start time, then a BINARY_RECORD for each message, with its millis since the start,
+    its id, the number of bytes in its payload and the payload. About half the size of the csv, and read without parsing by read_binary_log.
+    Returns the number of messages that were left out because they don't fit in a record, like ones with payloads that aren't hex.
+    '''
+    left_out = 0
+    with open(file) as fp, open(out_file, "wb") as out:
+        start_millis = read_header(fp)
+        np.array([(BINARY_MAGIC, start_millis)], dtype=BINARY_HEADER).tofile(out)
+        for chunk in pd.read_csv(fp, dtype=str, keep_default_na=False, on_bad_lines='skip', chunksize=chunk_size):
+            records, bad = records_from_log(clean_log(chunk, start_millis), start_millis)
+            records.tofile(out)
+            left_out += bad
+    return left_out
+
+def read_binary_log(file):
+    '''Memory map a binary log from convert_log. Returns its start time (unix millis) and a read only structured array of BINARY_RECORDs'''
+    header = np.fromfile(file, dtype=BINARY_HEADER, count=1)
+    if len(header) == 0 or header[0]["magic"] != BINARY_MAGIC:
+        raise ValueError(f"{file} is not a binary datalogger log")
+    if os.path.getsize(file) == BINARY_HEADER.itemsize:
+        return int(header[0]["start_millis"]), np.zeros(0, dtype=BINARY_RECORD)    #np.memmap can't map 0 bytes
+    return int(header[0]["start_millis"]), np.memmap(file, dtype=BINARY_RECORD, mode="r", offset=BINARY_HEADER.itemsize)
+
+def slice_records(records, start_millis, start=None, end=None):
+    '''Records from read_binary_log with unix millis in [start, end), as a view without copying. Logs are written in time order, so this is a binary search'''
+    first = 0 if start is None else np.searchsorted(records["millis"], start - start_millis, side="left")
+    last = len(records) if end is None else np.searchsorted(records["millis"], end - start_millis, side="left")
+    return records[first:last]
+
+def decode_records(records, start_millis, plans, skipped=None):
+    '''Decode BINARY_RECORDs from read_binary_log into the columns described in decode_columns'''
+    codes, unique_ids = pd.factorize(records["id"])
+    unique_ids = np.array([f"0x{can_id:03X}" for can_id in unique_ids])
+    decoded = decode_frames(codes, unique_ids, records["data"], records["len"], plans, skipped)
+    return make_columns(records["millis"].astype(np.int64) + int(start_millis), decoded, plans)
+
 def decode(file,canDef):
-    messages = []
+    '''Decode a whole raw datalogger log into the table described in decode_table'''
+    _, log = read_log(file)
+    skipped = Counter()
+    messages = decode_table(log, compile_can_def(canDef), skipped)
+    print_skipped(skipped)
+    return messages
+
+def iter_decode(file, plans, chunk_size=100000, fmt="npz", skipped=None):
+    '''
+    Decode a raw log chunk_size lines at a time, so memory doesn't grow with the log. Yields decode_columns dicts, or decode_table DataFrames for fmt "csv".
+    Binary logs (.bin, see convert_log) are decoded straight from the memory mapped records, and only to columns.
+    '''
+    if file.endswith(".bin"):
+        if fmt == "csv":
+            raise ValueError("binary logs can only be decoded to npz")
+        start_millis, records = read_binary_log(file)
+        for first in range(0, len(records), chunk_size):
+            yield decode_records(records[first:first + chunk_size], start_millis, plans, skipped)
+        return
+
+    for log in iter_log(file, chunk_size):
+        yield decode_table(log, plans, skipped) if fmt == "csv" else decode_columns(log, plans, skipped)
+
+def wait_for_line(fp, poll_interval):
+    '''Read a whole line from a file that is still being written'''
+    line = fp.readline()
+    while not line.endswith("\n"):
+        time.sleep(poll_interval)
+        line += fp.readline()
+    return line
+
+def follow_log(file, plans, poll_interval=0.2, skipped=None):
+    '''
+    Decode a log while the datalogger is still writing it, like tail -f. Checks for new lines every poll_interval seconds
+    and yields a decode_columns dict for each batch of new messages. Ends when the log reports that the datalogger lost power.
+    '''
     with open(file) as fp:
+        header = io.StringIO("".join(wait_for_line(fp, poll_interval) for _ in range(4)))
+        start_millis = read_header(header)
+        wait_for_line(fp, poll_interval) #column names
 
-        next(fp) #Mount
-        next(fp) #RTC Time Good
-        
-        time_row = next(fp)
-        start_millis = datetime.strptime(time_row[-20:-1], '%Y-%m-%d %H:%M:%S').timestamp() * 1000
-        print(f"start millis: {start_millis}")
-
-        next(fp) #SD mount time
-
-        # print(fp)
-        dlreader = csv.DictReader(fp, delimiter=',')
-        for row in tqdm(dlreader):
-            try:
-                msg = {
-                    "millis": int(row["millis"]) + int(start_millis),
-                    "id": row["id"],
-                    "hexString": row["data"]
-                }
-                can_struct = canDef[row["id"]]
-            except:
-                print("Can Message ID not found, skipping.", row)
+        partial = ""
+        while True:
+            new = fp.read()
+            if not new:
+                time.sleep(poll_interval)
+                continue
+
+            lines = (partial + new).split("\n")
+            partial = lines.pop()   #the datalogger may be in the middle of writing the last line
+            log = pd.read_csv(io.StringIO("\n".join(lines)), names=["millis", "id", "data"], dtype=str, keep_default_na=False, on_bad_lines='skip')
+            ended = log["millis"].str.startswith("Lost power").any()
+
+            log = clean_log(log, start_millis)
+            if len(log) > 0:
+                yield decode_columns(log, plans, skipped)
+            if ended:
+                return
+
+def load_decoded(path, signals=None, plans=None):
+    '''
+    Load decoded .npz telemetry from a file or a folder of them. signals is a list of signal names like
+    "0x702.bus_current_drawn_by_mc", or CAN ids like "0x702" for all of an id's signals. Defaults to every signal.
+    Returns a dict of signal name -> (millis, values), concatenated over files in time order.
+    Only the requested signals are read from disk.
+    With plans from compile_can_def, .csv tables from --format csv (or older decoders) are read too, by decoding their
+    hexString column again (see read_decoded_table). A folder is only searched for them if it has no .npz files.
+    '''
+    if os.path.isdir(path):
+        files = sorted(glob.glob(path + "/*.npz"))
+        if not files and plans is not None:
+            files = [file for file in sorted(glob.glob(path + "/*.csv")) if is_decoded_table(file)]
+    else:
+        files = [path]
+
+    parts = {}
+    for file in files:
+        if file.endswith(".csv"):
+            assert plans is not None, f"plans are needed to load {file}"
+            columns = read_decoded_table(file, plans)
+            for signal, value in columns.items():
+                can_id, name = signal.split(".", 1)
+                if name in ("millis", "names"):
+                    continue
+                if signals is not None and signal not in signals and can_id not in signals:
+                    continue
+                parts.setdefault(signal, []).append((columns[f"{can_id}.millis"], value))
+            continue
+
+        with np.load(file) as npz:
+            millis = {}
+            for key in npz.files:
+                signal, _, chunk = key.partition(":")    #decode_file writes each chunk of a log as "{signal}:{chunk}"
+                can_id, name = signal.split(".", 1)
+                if name in ("millis", "names"):
+                    continue
+                if signals is not None and signal not in signals and can_id not in signals:
+                    continue
+                millis_key = f"{can_id}.millis:{chunk}" if chunk else f"{can_id}.millis"
+                if millis_key not in millis:
+                    millis[millis_key] = npz[millis_key]
+                parts.setdefault(signal, []).append((millis[millis_key], npz[key]))
+
+    loaded = {}
+    for signal, signal_parts in parts.items():
+        millis = np.concatenate([p[0] for p in signal_parts])
+        values = np.concatenate([p[1] for p in signal_parts])
+        order = np.argsort(millis, kind='stable')
+        loaded[signal] = (millis[order], values[order])
+    return loaded
+
+DECODED_TABLE_HEADER = "millis,id,hexString"
+
+def is_decoded_table(file):
+    '''True if file is a csv table from decode_table, rather than eg. a csv made from one'''
+    with open(file) as fp:
+        return fp.readline().startswith(DECODED_TABLE_HEADER)
+
+def read_decoded_table(file, plans, skipped=None):
+    '''
+    Read a csv table from decode_table into typed columns like decode_columns, by decoding its hexString column again
+    with plans. Its parsedValue column is ignored, so tables made by older decoders load with the current ones.
+    '''
+    table = pd.read_csv(file, usecols=["millis", "id", "hexString"], dtype={"millis": np.int64, "id": str, "hexString": str})
+    return decode_columns(table.rename(columns={"hexString": "data"}), plans, skipped)
+
+def write_npz_chunk(npz, columns, chunk):
+    '''Add decode_columns from one chunk of a log to an open npz zip file, with keys "{signal}:{chunk}"'''
+    for key, value in columns.items():
+        with npz.open(f"{key}:{chunk}.npy", "w", force_zip64=True) as fp:
+            np.lib.format.write_array(fp, np.asanyarray(value), allow_pickle=False)
+
+def decode_file(file, output_folder, plans, fmt="npz", chunk_size=100000):
+    '''
+    Decode a raw log into output_folder chunk_size lines at a time, named by the time of its first message. fmt "npz" writes
+    compressed typed columns (see decode_columns and load_decoded), "csv" writes the table from decode_table.
+    Returns the output path, or None if the log is empty.
+    '''
+    out_file = None
+    skipped = Counter()
+    with ExitStack() as stack:
+        for chunk, decoded in enumerate(iter_decode(file, plans, chunk_size, fmt, skipped)):
+            if len(decoded) == 0:
                 continue
-            
-            try:
-                parsedValue = decode_array(row["data"], row["id"], canDef, can_struct["DataFormat"], can_struct["DataQty"])
-            except Exception as e:
-                print("Caught exception for row", row, e)
-            
-            if "Multiplier" in can_struct and row["id"]!='0x5E4':
-                if isinstance(can_struct["Multiplier"], list):
-                    for i in range(len(parsedValue)):
-                        parsedValue[i] *= can_struct["Multiplier"][i]
+
+            if out_file is None:
+                if fmt == "csv":
+                    first_millis = decoded["millis"].iloc[0]
                 else:
-                    for i in range(len(parsedValue)):
-                        parsedValue[i] *= can_struct["Multiplier"]
-            msg["length"] = len(parsedValue)
-            msg["parsedValue"] = parsedValue
-            
-            messages.append(msg)
-    return messages
+                    first_millis = min(v[0] for k, v in decoded.items() if k.endswith(".millis"))
+                date = datetime.fromtimestamp(first_millis/1000.0)
+                date = date.strftime('%Y-%m-%d_%H-%M-%S')
 
+                out_file = output_folder + "/" + str(date) + '.' + fmt
+                if fmt == "csv":
+                    out = stack.enter_context(open(out_file, "w", newline=""))
+                else:
+                    out = stack.enter_context(zipfile.ZipFile(out_file, "w", compression=zipfile.ZIP_DEFLATED))
 
-def decode_folder(input_folder, output_folder, canDef):
-    files = glob.glob(input_folder +"/*.csv")
-    print(f"\n decoding {len(files)} files from {input_folder} \n")
-    for file in tqdm(files):
-        # print(file)
-        messages = decode(file, canDef)
+            if fmt == "csv":
+                decoded.to_csv(out, index = False, header=(out.tell() == 0))
+            else:
+                write_npz_chunk(out, decoded, chunk)
+    print_skipped(skipped, os.path.basename(file) + ": ")
+    return out_file
 
-        # json.dump(messages, fp, indent=4)
+def print_latest(columns, signals=None):
+    '''Print the latest value of each CAN id in a batch of decode_columns, optionally only for some signals or ids'''
+    for key, millis in columns.items():
+        if not key.endswith(".millis"):
+            continue
+        can_id = key[:-len(".millis")]
+        names = [name for name in columns[f"{can_id}.names"] if signals is None or can_id in signals or f"{can_id}.{name}" in signals]
+        if len(names) == 0:
+            continue
+        time_str = datetime.fromtimestamp(millis[-1]/1000.0).strftime('%H:%M:%S.%f')[:-3]
+        print(time_str, can_id, " ".join(f"{name}={columns[f'{can_id}.{name}'][-1]}" for name in names))
 
-        df = pd.DataFrame.from_dict(messages)
+worker_plans = None    #decode plans of a decode_folder worker process, set once by init_worker
 
-        date = datetime.fromtimestamp(messages[0].get("millis")/1000.0)
-        date = date.strftime('%Y-%m-%d_%H-%M-%S')
+def init_worker(plans):
+    global worker_plans
+    worker_plans = plans
 
-        df.to_csv(output_folder + "/" + str(date) + '.csv', index = False, header=True)
-    
-    
-    # elif(args.database):
-    #     client = pymongo.MongoClient(args.host, 27017)
-    #     db = client["solarcar"]
-    #     collection = db["messages"]
-    #     collection.insert_many(messages)
-    #     collection.insert_many(messages)
+def decode_file_worker(file, output_folder, fmt, chunk_size):
+    return decode_file(file, output_folder, worker_plans, fmt, chunk_size)
+
+def file_hash(file):
+    '''sha1 of the contents of a file'''
+    sha1 = hashlib.sha1()
+    with open(file, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def can_def_version(canDef):
+    '''Hash of a canDef, recorded in the manifest so logs are decoded again when canDef changes'''
+    return hashlib.sha1(json.dumps(canDef, sort_keys=True).encode()).hexdigest()
+
+def read_manifest(output_folder):
+    '''
+    Read the manifest decode_folder keeps in output_folder. Returns a dict of raw log name -> dict with its "path", "size",
+    "mtime" and "sha1", the "decoder" version, "canDef" version and "format" it was decoded with, and its "output" file name
+    (None for an empty log). Empty if nothing has been decoded into output_folder yet.
+    '''
+    path = os.path.join(output_folder, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+def write_manifest(output_folder, manifest):
+    path = os.path.join(output_folder, MANIFEST)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)    #never leave a half written manifest if decoding is interrupted
+
+def log_info(file, entry=None):
+    '''Path, size, mtime and sha1 of a raw log. Only hashes the log if its size or mtime differ from its manifest entry'''
+    stat = os.stat(file)
+    info = {"path": os.path.abspath(file), "size": stat.st_size, "mtime": stat.st_mtime}
+    if entry and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+        info["sha1"] = entry["sha1"]
+    else:
+        info["sha1"] = file_hash(file)
+    return info
+
+def decode_folder(input_folder, output_folder, plans, jobs=1, fmt="npz", chunk_size=100000, version="", force=False):
+    '''
+    Decode the raw logs in input_folder that are new or changed since they were last decoded into output_folder, as recorded in
+    its manifest (see read_manifest). version is the canDef version (see can_def_version); logs decoded with a different
+    version, decoder or fmt are decoded again, and force decodes everything. jobs is the number of worker processes (0 for one per cpu).
+    Files are always processed and reported in sorted order, so the output is the same for any number of jobs.
+    Returns the output path of every log in input_folder.
+    '''
+    files = sorted(glob.glob(input_folder +"/*.csv") + glob.glob(input_folder +"/*.bin"))
+    manifest = read_manifest(output_folder)
+
+    infos = {}
+    for file in files:
+        name = os.path.basename(file)
+        entry = manifest.get(name)
+        info = dict(log_info(file, entry), decoder=DECODER_VERSION, canDef=version, format=fmt)
+        unchanged = entry and all(entry.get(key) == info[key] for key in ("sha1", "decoder", "canDef", "format"))
+        if unchanged and (entry["output"] is None or os.path.exists(os.path.join(output_folder, entry["output"]))) and not force:
+            entry.update(info)  #the log may have been copied or moved without changing
+        else:
+            infos[file] = info
+    todo = list(infos)
+    write_manifest(output_folder, manifest)
+    print(f"\n decoding {len(todo)} of {len(files)} files from {input_folder} \n")
+
+    def finish(file, out_file):
+        #only record a log once it's decoded, so an interrupted run decodes it again next time
+        name = os.path.basename(file)
+        old = manifest.get(name, {}).get("output")
+        if old and os.path.join(output_folder, old) != out_file and os.path.exists(os.path.join(output_folder, old)):
+            os.remove(os.path.join(output_folder, old))
+        manifest[name] = dict(infos[file], output=(out_file and os.path.basename(out_file)))
+        write_manifest(output_folder, manifest)
+
+    if jobs == 1:
+        for file in tqdm(todo):
+            finish(file, decode_file(file, output_folder, plans, fmt, chunk_size))
+    else:
+        with ProcessPoolExecutor(max_workers=(jobs or None), initializer=init_worker, initargs=(plans,)) as executor:
+            #start the largest files first so they don't finish last, but collect results in order
+            futures = {file: executor.submit(decode_file_worker, file, output_folder, fmt, chunk_size)
+                       for file in sorted(todo, key=os.path.getsize, reverse=True)}
+            for file in tqdm(todo):
+                finish(file, futures[file].result())
+
+    outputs = [manifest[os.path.basename(file)]["output"] for file in files]
+    return [output and os.path.join(output_folder, output) for output in outputs]
+
+def update_combined(output_folder, combined_file, make_part):
+    '''
+    Keep a csv that combines every log decoded into output_folder up to date. make_part(decoded_file) makes the DataFrame
+    for one decoded log (or returns None to leave it out), and is only called for logs that are new or were decoded again
+    since the last update, found with the manifest. Rows have a "source" column naming the decoding they came from.
+    Folders decoded before the manifest existed have none, so their .npz files (or decode_table csvs if there are no
+    .npz files) are the sources instead, named by their contents.
+    Returns the combined DataFrame, sorted by its index.
+    '''
+    sources = {}
+    for entry in read_manifest(output_folder).values():
+        if entry["output"]:
+            sources[f'{entry["output"]}:{entry["sha1"][:12]}:{entry["decoder"]}:{entry["canDef"][:12]}'] = entry["output"]
+    if not sources:
+        files = sorted(glob.glob(output_folder + "/*.npz"))
+        if not files:
+            files = [file for file in sorted(glob.glob(output_folder + "/*.csv")) if is_decoded_table(file)]
+        for file in files:
+            sources[f'{os.path.basename(file)}:{file_hash(file)[:12]}'] = os.path.basename(file)
+
+    combined = pd.DataFrame({"source": []})
+    if os.path.exists(combined_file):
+        combined = pd.read_csv(combined_file, index_col=0, parse_dates=True)
+        if "source" not in combined:    #made before update_combined, start over
+            combined = pd.DataFrame({"source": []})
+    kept = combined["source"].isin(sources)
+    parts = [combined[kept]]
+    for source in tqdm(sorted(set(sources) - set(combined["source"]))):
+        part = make_part(os.path.join(output_folder, sources[source]))
+        if part is not None:
+            parts.append(part.assign(source=source))
+    if kept.all() and len(parts) == 1:
+        return combined
+
+    combined = pd.concat(parts, sort=True).sort_index()
+    combined.to_csv(combined_file, index=True)
+    return combined
+
+#sqlite database for --database: a row per sample of every signal, like the columns of decode_columns.
+#sqlite integers are signed 64 bit, so Uint64LE values are stored as the int64 with the same bits (see write_database_chunk)
+DATABASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, name TEXT UNIQUE, sha1 TEXT, decoder INTEGER, canDef TEXT, complete INTEGER, samples INTEGER);
+CREATE TABLE IF NOT EXISTS signals (id INTEGER PRIMARY KEY, name TEXT UNIQUE, can_id TEXT);
+CREATE TABLE IF NOT EXISTS samples (signal INTEGER, millis INTEGER, value, source INTEGER);
+CREATE INDEX IF NOT EXISTS samples_signal_millis ON samples (signal, millis);
+"""
+
+def open_database(database, timeout=600):
+    '''
+    Open (or create) a sqlite telemetry database. Tables:
+        sources: each raw log loaded, with the sha1, decoder and canDef versions it was decoded with, and whether it finished loading
+        signals: signal names like "0x702.bus_current_drawn_by_mc" and their CAN id
+        samples: signal, millis, value and source of every sample, indexed by (signal, millis). Bitmaps are stored as integers,
+            and uint64 values as the int64 with the same bits, so values >= 2^63 are negative (.view(np.uint64) gets them back).
+    The database is in WAL mode so it can be read while logs are loaded, and loaders in other processes wait up to timeout seconds for their turn to write.
+    '''
+    db = sqlite3.connect(database, timeout=timeout)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(DATABASE_SCHEMA)
+    return db
+
+def signal_id(db, signal, ids):
+    '''Row id of a signal in the signals table, added if it's new. ids caches them for a connection'''
+    if signal not in ids:
+        db.execute("INSERT OR IGNORE INTO signals (name, can_id) VALUES (?, ?)", (signal, signal.split(".", 1)[0]))
+        ids[signal] = db.execute("SELECT id FROM signals WHERE name = ?", (signal,)).fetchone()[0]
+    return ids[signal]
+
+def write_database_chunk(db, columns, source, ids):
+    '''Insert decode_columns from one chunk of a log into the samples table, in one transaction. Returns the number of samples'''
+    count = 0
+    with db:
+        for key, values in columns.items():
+            can_id, name = key.split(".", 1)
+            if name in ("millis", "names"):
+                continue
+            values = np.asarray(values)
+            if values.ndim == 2:    #bitmap bits, bit 0 first
+                values = (values.astype(np.int64) << np.arange(values.shape[1])).sum(axis=1)
+            elif values.dtype == np.uint64:     #sqlite can't store ints >= 2^63
+                values = values.view(np.int64)
+            millis = np.asarray(columns[f"{can_id}.millis"])
+            db.executemany("INSERT INTO samples VALUES (?, ?, ?, ?)",
+                           zip(repeat(signal_id(db, key, ids)), millis.tolist(), values.tolist(), repeat(source)))
+            count += len(millis)
+    return count
+
+def decode_to_database(file, database, plans, info, chunk_size=100000):
+    '''
+    Decode a raw log into a database from open_database, replacing anything loaded from a log with the same name.
+    info is the log's sources row (see log_info). Chunks are decoded before taking the write lock, so parallel loaders mostly decode
+    while one writes. The log is marked complete at the end, so a log that was interrupted is loaded again. Returns the number of samples.
+    '''
+    name = os.path.basename(file)
+    db = open_database(database)
+    with db:
+        db.execute("DELETE FROM samples WHERE source IN (SELECT id FROM sources WHERE name = ?)", (name,))
+        db.execute("DELETE FROM sources WHERE name = ?", (name,))
+        source = db.execute("INSERT INTO sources (name, sha1, decoder, canDef, complete, samples) VALUES (?, ?, ?, ?, 0, 0)",
+                            (name, info["sha1"], info["decoder"], info["canDef"])).lastrowid
+
+    ids = {}
+    count = 0
+    skipped = Counter()
+    for columns in iter_decode(file, plans, chunk_size, "npz", skipped):
+        count += write_database_chunk(db, columns, source, ids)
+    with db:
+        db.execute("UPDATE sources SET complete = 1, samples = ? WHERE id = ?", (count, source))
+    db.close()
+    print_skipped(skipped, name + ": ")
+    return count
+
+def decode_database_worker(file, database, info, chunk_size):
+    return decode_to_database(file, database, worker_plans, info, chunk_size)
+
+def decode_database(input_folder, database, plans, jobs=1, chunk_size=100000, version="", force=False):
+    '''
+    Load the raw logs in input_folder into a sqlite database (see open_database), skipping logs that were already loaded completely
+    with the same contents, decoder and canDef version, unless force. jobs is the number of worker processes (0 for one per cpu), which
+    all write to the database. Returns the total number of samples loaded.
+    '''
+    files = sorted(glob.glob(input_folder +"/*.csv") + glob.glob(input_folder +"/*.bin"))
+    db = open_database(database)
+    loaded = {row[0]: row[1:] for row in db.execute("SELECT name, sha1, decoder, canDef FROM sources WHERE complete = 1")}
+    db.close()
+
+    infos = {}
+    for file in files:
+        info = dict(log_info(file), decoder=DECODER_VERSION, canDef=version)
+        if force or loaded.get(os.path.basename(file)) != (info["sha1"], info["decoder"], info["canDef"]):
+            infos[file] = info
+    print(f"\n loading {len(infos)} of {len(files)} files from {input_folder} into {database} \n")
+
+    if jobs == 1:
+        return sum(decode_to_database(file, database, plans, info, chunk_size) for file, info in tqdm(infos.items()))
+    with ProcessPoolExecutor(max_workers=(jobs or None), initializer=init_worker, initargs=(plans,)) as executor:
+        futures = [executor.submit(decode_database_worker, file, database, info, chunk_size)
+                   for file, info in sorted(infos.items(), key=lambda item: item[1]["size"], reverse=True)]
+        return sum(future.result() for future in tqdm(futures))
+
+def load_database(database, signals, start=None, end=None):
+    '''
+    Samples of some signals (names, or CAN ids for all of an id's signals) between start and end (unix millis) from a database made
+    by decode_database. Returns a dict of signal name -> (millis, values) sorted by time, like load_decoded.
+    '''
+    db = sqlite3.connect(database)
+    names = db.execute(f"SELECT id, name FROM signals WHERE name IN ({','.join('?' * len(signals))}) OR can_id IN ({','.join('?' * len(signals))})",
+                       list(signals) * 2).fetchall()
+    loaded = {}
+    for row_id, name in names:
+        rows = db.execute("SELECT millis, value FROM samples WHERE signal = ? AND millis >= ? AND millis < ? ORDER BY millis",
+                          (row_id, -2**63 if start is None else start, 2**63 - 1 if end is None else end)).fetchall()
+        millis, values = zip(*rows) if rows else ((), ())
+        loaded[name] = (np.array(millis, dtype=np.int64), np.array(values))
+    db.close()
+    return loaded
 
 def main():
     parser = argparse.ArgumentParser(description='Decode data logger data')
     parser.add_argument("-i", "--input", type=str, required=True, help='input data logger file')
     parser.add_argument("-o", "--output", type=str, help='output file')
-    parser.add_argument("-d", "--database", action="store_true", help="write output to a database")
-    parser.add_argument("--host", type=str, default="localhost", help="Host name of database")
+    parser.add_argument("-d", "--database", type=str, help="sqlite database file to load the decoded logs into (see open_database)")
     parser.add_argument("--can", type=str, default="./canDef.json", help="Path to CAN def json")
+    parser.add_argument("-f", "--format", type=str, default="npz", choices=["npz", "csv"], help="Output format: typed columns (npz) or the old csv table")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of files to decode in parallel (0 for one per cpu)")
+    parser.add_argument("--chunk-size", type=int, default=100000, help="Number of lines of a log to decode at a time")
+    parser.add_argument("--force", action="store_true", help="Decode every log again, even ones the manifest says haven't changed")
+    parser.add_argument("--convert", action="store_true", help="Convert the raw csv logs in the input folder to binary logs in the output folder instead of decoding them")
+    parser.add_argument("--follow", action="store_true", help="Decode a log (or the newest log in a folder) live while the datalogger writes it, printing the latest values")
+    parser.add_argument("-s", "--signals", type=str, nargs="*", help="Signals or CAN ids to print in --follow mode, eg. 0x703 0x702.bus_voltage_of_mc")
     args = parser.parse_args()
+    if args.convert and args.database:
+        parser.error("--convert writes binary logs to -o/--output, it can't be combined with -d/--database")
+    if args.convert and args.output is None:
+        parser.error("--convert needs -o/--output")
+
+    canDefPath = args.can
+    with open(canDefPath) as fp:
+        canDef = json.load(fp)
+    plans = compile_can_def(canDef)
+
+    if args.follow:
+        file = args.input if os.path.isfile(args.input) else max(glob.glob(args.input + "/*.csv"), key=os.path.getmtime)
+        print(f"following {file}")
+        skipped = Counter()
+        for columns in follow_log(file, plans, skipped=skipped):
+            print_latest(columns, args.signals)
+        print_skipped(skipped)
+        return
 
     if (not args.database) and (args.output == None):
         print("Must either specify output file or database.")
         quit()
 
-    canDefPath = args.can
-    with open(canDefPath) as fp:
-        canDef = json.load(fp)
+    if args.convert:
+        for file in tqdm(sorted(glob.glob(args.input + "/*.csv"))):
+            left_out = convert_log(file, os.path.join(args.output, os.path.basename(file)[:-len(".csv")] + ".bin"), args.chunk_size)
+            if left_out:
+                print(f"{os.path.basename(file)}: left out {left_out} messages that aren't valid")
+        return
 
-    decode_folder(args.input, args.output, canDef)
+    if args.database:
+        decode_database(args.input, args.database, plans, jobs=args.jobs, chunk_size=args.chunk_size,
+                        version=can_def_version(canDef), force=args.force)
+    if args.output:
+        decode_folder(args.input, args.output, plans, jobs=args.jobs, fmt=args.format, chunk_size=args.chunk_size,
+                      version=can_def_version(canDef), force=args.force)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,215 @@
+'''
+Fits the motor power coefficients of a car (P_drag, P_fric and P_accel in cars/*.json) to telemetry, using the same model
+as simulator.raceEnv.motor_power with no wind:
+    volt * current = speed * (P_drag*speed^2 + P_fric + mass*g*sin(slope)) + P_accel*accel*speed
+The data is streamed in chunks (one decoded log or one hour of a TelemetryStore at a time) and only the normal equations of
+the least squares fit are kept, so any amount of data fits in memory. Fit quality is reported per driving session.
+
+To fit a car to decoded logs and save it as cars/brizo_fit.json, which can be simulated with RaceEnv(car="brizo_fit"):
+    python3 analysis/data/carfit.py -i analysis/data/datalogger_fsgp2022_day1/decoded --name brizo_fit
+'''
+
+import numpy as np
+import pandas as pd
+import os, sys
+import json
+import glob
+import argparse
+from scipy.signal import savgol_filter
+from scipy.optimize import nnls
+from tqdm import tqdm
+
+dir = os.path.dirname(__file__)
+sys.path.insert(0, dir+'/..')   #allow imports from parent directory "analysis"
+
+from data.DataloggerDecoder import load_decoded
+from data.telemetry import resample, segment_sessions, local_datetimes
+
+CARS_DIR = os.path.join(dir, '../../cars')
+COEFFS = ['P_drag', 'P_fric', 'P_accel']
+
+#(column, signal, resample method) of the telemetry used in the fit
+FIT_SIGNALS = [
+    ("speed", "0x703.vehicle_velocity", "interp"),
+    ("volt", "0x702.bus_voltage_of_mc", "interp"),
+    ("current", "0x702.bus_current_drawn_by_mc", "interp"),
+    ("brake", "0x250.brake_sensor_status", "hold"),
+]
+
+
+def fit_samples(signals:dict, rate=10, smoothness=21, slope_signal=None, extra=[]):
+    '''
+    Resample one chunk of telemetry (dict from load_decoded or TelemetryStore.query) for fitting. Returns a DataFrame with
+    speed (m/s), accel (m/s^2, from a smoothed derivative of speed), power (volt*current, W), brake, sinslope and session
+    (see telemetry.segment_sessions). slope_signal is the name of a signal in signals with the sin of the road grade, or 0 if None.
+    extra is a list of more resample specs to add as columns.
+    '''
+    specs = FIT_SIGNALS + ([("sinslope", slope_signal, "interp")] if slope_signal else []) + extra
+    if any(signal not in signals or len(signals[signal][0]) == 0 for _, signal, _ in specs):
+        return None
+    samples = resample(signals, specs, rate=rate, max_gap=2000)
+    if len(samples) <= smoothness:
+        return None
+
+    dt = 1. / rate
+    speeds = samples["speed"].to_numpy()
+    samples["accel"] = savgol_filter(speeds, window_length=smoothness, polyorder=2, deriv=1, delta=dt)
+    samples["speed"] = savgol_filter(speeds, window_length=smoothness, polyorder=2)
+    samples["power"] = samples["volt"] * samples["current"]
+    if not slope_signal:
+        samples["sinslope"] = 0.
+    samples["session"], _ = segment_sessions(samples["timestamp"].to_numpy() * 1000, np.nan_to_num(speeds))
+    return samples
+
+
+def fit_mask(samples, min_speed=1., max_accel=1., max_current=100.):
+    '''Samples to fit to: moving, not braking, not accelerating too hard, a sane current, and no missing values'''
+    return ((samples["speed"] > min_speed) & (samples["accel"].abs() < max_accel) & (samples["brake"] == 0)
+            & (samples["current"].abs() < max_current) & np.isfinite(samples[["speed", "accel", "power", "sinslope"]]).all(axis=1)).to_numpy()
+
+
+def design(samples, mass):
+    '''Least squares design matrix (columns match COEFFS) and target power for the model in the module docstring'''
+    v = samples["speed"].to_numpy()
+    A = np.stack([v**3, v, samples["accel"].to_numpy() * v], axis=1)
+    b = samples["power"].to_numpy() - mass * 9.81 * samples["sinslope"].to_numpy() * v
+    return A, b
+
+
+class NormalEquations():
+    '''Running sums that determine a least squares fit of b ~ A @ x and its error, without keeping A or b'''
+
+    def __init__(self, k=len(COEFFS)):
+        self.AtA = np.zeros((k, k))
+        self.Atb = np.zeros(k)
+        self.btb = 0.
+        self.b_sum = 0.
+        self.n = 0
+
+    def add(self, A, b):
+        self.AtA += A.T @ A
+        self.Atb += A.T @ b
+        self.btb += b @ b
+        self.b_sum += b.sum()
+        self.n += len(b)
+
+    def __iadd__(self, other):
+        self.AtA += other.AtA
+        self.Atb += other.Atb
+        self.btb += other.btb
+        self.b_sum += other.b_sum
+        self.n += other.n
+        return self
+
+    def solve(self, nonnegative=True):
+        '''Least squares coefficients, optionally constrained to be >= 0 (by solving the equivalent problem with the Cholesky factor of AtA)'''
+        if not nonnegative:
+            return np.linalg.lstsq(self.AtA, self.Atb, rcond=None)[0]
+        L = np.linalg.cholesky(self.AtA)
+        return nnls(L.T, np.linalg.solve(L, self.Atb))[0]
+
+    def quality(self, x):
+        '''RMSE (W) and R^2 of coefficients x on the data added'''
+        sse = self.btb - 2 * x @ self.Atb + x @ self.AtA @ x
+        sst = self.btb - self.b_sum**2 / self.n
+        return np.sqrt(max(sse, 0) / self.n), 1 - sse / sst if sst > 0 else np.nan
+
+
+def fit_car(chunks, mass, slope_signal=None, join_gap=60, nonnegative=True, **filters):
+    '''
+    Fit COEFFS to chunks, an iterable of telemetry dicts in time order (see iter_decoded and iter_store). A session at the start
+    of a chunk that begins within join_gap seconds of the end of the last one continues it. slope_signal is passed to fit_samples
+    and filters to fit_mask. Coefficients are kept >= 0 unless nonnegative is False, since negative drag or friction can't be simulated.
+    Returns the coefficients as a dict, and a DataFrame with the start, end, samples, RMSE and R^2 of the fit for each session,
+    plus a row for all of them.
+    '''
+    sessions = []
+    for signals in chunks:
+        samples = fit_samples(signals, slope_signal=slope_signal)
+        if samples is None:
+            continue
+        samples = samples[fit_mask(samples, **filters) & (samples["session"] >= 0).to_numpy()]
+        A, b = design(samples, mass)
+
+        session_ids = samples["session"].to_numpy()
+        timestamps = samples["timestamp"].to_numpy()
+        for session in np.unique(session_ids):
+            rows = session_ids == session
+            start = timestamps[rows][0]
+            #a session that continues into the next chunk is joined back together
+            if session != session_ids[0] or not sessions or start - sessions[-1]["end"] > join_gap:
+                sessions.append({"equations": NormalEquations(), "start": start})
+            sessions[-1]["equations"].add(A[rows], b[rows])
+            sessions[-1]["end"] = timestamps[rows][-1]
+
+    if not sessions:
+        raise ValueError("no telemetry to fit to")
+    total = NormalEquations()
+    for session in sessions:
+        total += session["equations"]
+    x = total.solve(nonnegative)
+
+    rows = []
+    for session in sessions + [{"equations": total, "start": sessions[0]["start"], "end": sessions[-1]["end"]}]:
+        rmse, r_squared = session["equations"].quality(x)
+        rows.append({"start": session["start"], "end": session["end"], "samples": session["equations"].n, "rmse": rmse, "r_squared": r_squared})
+    report = pd.DataFrame(rows)
+    report["start"] = local_datetimes(report["start"] * 1000)
+    report["end"] = local_datetimes(report["end"] * 1000)
+    report.index = list(range(len(sessions))) + ["all"]
+    return dict(zip(COEFFS, x)), report
+
+
+def iter_decoded(folders, signals=None):
+    '''Telemetry from every decoded .npz log in some folders, one log at a time'''
+    signals = signals or [signal for _, signal, _ in FIT_SIGNALS]
+    for file in tqdm(sorted(f for folder in folders for f in glob.glob(folder + "/*.npz"))):
+        yield load_decoded(file, signals)
+
+
+def iter_store(store, start=None, end=None, chunk_millis=3600*1000, signals=None):
+    '''Telemetry from a TelemetryStore between start and end (unix millis), chunk_millis at a time'''
+    signals = signals or [signal for _, signal, _ in FIT_SIGNALS]
+    everything = store.index["chunks"]
+    firsts = [first for signal in signals for first, _, _ in everything.get(signal, {}).values()]
+    lasts = [last for signal in signals for _, last, _ in everything.get(signal, {}).values()]
+    if not firsts:
+        return
+    start = min(firsts) if start is None else start
+    end = max(lasts) + 1 if end is None else end
+    for chunk_start in range(int(start), int(end), chunk_millis):
+        yield store.query(signals, chunk_start, min(chunk_start + chunk_millis, end))
+
+
+def save_car(coeffs:dict, name:str, base="brizo_fsgp22", report=None):
+    '''Write cars/{name}.json: the base car with the fitted coefficients, and a summary of the fit if there's a report from fit_car'''
+    with open(f"{CARS_DIR}/{base}.json") as fp:
+        car = json.load(fp)
+    car["name"] = name
+    car.update({coeff: round(float(value), 5) for coeff, value in coeffs.items()})
+    if report is not None:
+        car["fit"] = {"samples": int(report.loc["all", "samples"]), "rmse": round(float(report.loc["all", "rmse"]), 2),
+                      "r_squared": round(float(report.loc["all", "r_squared"]), 4), "base": base}
+    with open(f"{CARS_DIR}/{name}.json", "w") as fp:
+        json.dump(car, fp, indent=4)
+    return car
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit car power coefficients to decoded telemetry and save them as a car')
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True, help='folders of decoded .npz logs')
+    parser.add_argument("--name", type=str, required=True, help='name of the car to write to cars/')
+    parser.add_argument("--base", type=str, default="brizo_fsgp22", help='car in cars/ to copy everything else from')
+    args = parser.parse_args()
+
+    with open(f"{CARS_DIR}/{args.base}.json") as fp:
+        mass = json.load(fp)["mass"]
+    coeffs, report = fit_car(iter_decoded(args.input), mass)
+    print(report.to_string())
+    print(coeffs)
+    save_car(coeffs, args.name, args.base, report)
+    print(f"saved cars/{args.name}.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+'''
+Plotting data for long telemetry (or simulator) traces. Plotting hundreds of thousands of points makes zooming and panning slow,
+so each signal gets a Pyramid: the indices of the min and max sample in buckets of x that grow by FACTOR each level, built once.
+A query for a window and a width in pixels picks the coarsest level that still has a bucket per pixel and returns only
+those mins and maxes, which look the same as the raw points but are at most a few thousand.
+
+In a notebook with %matplotlib widget:
+    signals = load_decoded("data/datalogger_fsgp2022_day1/decoded")     #a folder decoded by DataloggerDecoder.py
+    cache = PlotCache(signals)
+    fig, ax = plt.subplots()
+    DownsampledLine(ax, cache["0x703.vehicle_velocity"])    #redraws from the pyramid when the x limits change
+'''
+
+import numpy as np
+import os, sys
+
+dir = os.path.dirname(__file__)
+sys.path.insert(0, dir+'/../..')    #allow imports from the repository root
+
+from util import lttb
+
+FACTOR = 4      #buckets get this much wider each level
+
+
+class Pyramid():
+    '''
+    Min/max envelopes of one signal (x sorted, eg. unix millis or meters). Level k splits x into buckets of width*FACTOR^k, starting
+    at a few samples per bucket, and keeps the indices of the min and max sample of every bucket that has samples (so gaps cost nothing).
+    '''
+
+    def __init__(self, x, y, factor=FACTOR):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.factor = factor
+        steps = np.diff(self.x)
+        steps = steps[steps > 0]
+        self.width = np.median(steps) * factor if len(steps) else 1.
+        self.x0 = self.x[0] if len(self.x) else 0.
+
+        #levels[k] is (bucket numbers, min index, max index) of the buckets with samples, which are in order
+        self.levels = []
+        lows = np.where(np.isnan(self.y), np.inf, self.y)       #so NaNs are never picked
+        highs = np.where(np.isnan(self.y), -np.inf, self.y)
+        buckets = np.floor((self.x - self.x0) / self.width).astype(np.int64)
+        lo = hi = np.arange(len(self.x))
+        while len(buckets) > 1:
+            lo = lo[self._pick(buckets, lows[lo])]
+            hi = hi[self._pick(buckets, -highs[hi])]
+            buckets = np.unique(buckets)
+            self.levels.append((buckets, lo, hi))
+            buckets = buckets // factor
+
+    @staticmethod
+    def _pick(buckets, values):
+        '''Position of the smallest value in each run of equal (sorted) bucket numbers'''
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+        smallest = np.repeat(np.minimum.reduceat(values, starts), np.diff(starts, append=len(values)))
+        matches = np.flatnonzero(values == smallest)
+        return matches[np.searchsorted(matches, starts)]
+
+    def __len__(self):
+        return len(self.x)
+
+    def query(self, left=None, right=None, width=1000, method="minmax"):
+        '''
+        Points to draw the signal between x = left and right (default everything) on width pixels. "minmax" keeps the min and max of
+        every bucket of at most a pixel, so the plot looks like the raw data. "lttb" further reduces those to width points with util.lttb.
+        One point either side of the window is included so lines reach the edges. Returns x and y arrays.
+        '''
+        if len(self.x) == 0:
+            return self.x, self.y
+        left = self.x0 if left is None else left
+        right = self.x[-1] if right is None and len(self.x) else right
+        i0 = max(np.searchsorted(self.x, left, side='left') - 1, 0)
+        i1 = min(np.searchsorted(self.x, right, side='right') + 1, len(self.x))
+
+        level = -1
+        pixel = (right - left) / width
+        if i1 - i0 > 2*width and pixel >= self.width:
+            level = min(int(np.log(pixel / self.width) / np.log(self.factor)), len(self.levels) - 1)    #coarsest level with buckets <= a pixel
+        if level < 0:
+            idx = np.arange(i0, i1)
+        else:
+            buckets, lo, hi = self.levels[level]
+            size = self.width * self.factor**level
+            b0 = max(np.searchsorted(buckets, np.floor((left - self.x0) / size), side='left') - 1, 0)
+            b1 = np.searchsorted(buckets, np.floor((right - self.x0) / size), side='right') + 1
+            idx = np.sort(np.stack([lo[b0:b1], hi[b0:b1]]), axis=0).T.ravel()
+        x, y = self.x[idx], self.y[idx]
+        if method == "lttb":
+            return lttb(x, y, width)
+        elif method != "minmax":
+            raise ValueError(f"unknown downsample method {method}")
+        return x, y
+
+
+class PlotCache():
+    '''
+    Pyramids of the signals in a dict of signal name -> (x, values), like load_decoded or TelemetryStore.query return,
+    built the first time each one is used. Signals can also be added later, eg. a simulator trace.
+    '''
+
+    def __init__(self, signals:dict=None):
+        self.signals = dict(signals or {})
+        self.pyramids = {}
+
+    def add(self, name, x, y):
+        self.signals[name] = (x, y)
+        self.pyramids.pop(name, None)
+
+    def __getitem__(self, name):
+        if name not in self.pyramids:
+            self.pyramids[name] = Pyramid(*self.signals[name])
+        return self.pyramids[name]
+
+    def query(self, name, left=None, right=None, width=1000, method="minmax"):
+        return self[name].query(left, right, width, method)
+
+
+class DownsampledLine():
+    '''A matplotlib line of a Pyramid that redraws the points for the visible window whenever the x limits of ax change'''
+
+    def __init__(self, ax, pyramid:Pyramid, method="minmax", **kwargs):
+        self.ax = ax
+        self.pyramid = pyramid
+        self.method = method
+        (self.line,) = ax.plot(*pyramid.query(width=self.width(), method=method), **kwargs)
+        ax.callbacks.connect('xlim_changed', self.update)
+
+    def width(self):
+        return max(int(self.ax.get_window_extent().width), 1)
+
+    def update(self, ax=None):
+        left, right = self.ax.get_xlim()
+        self.line.set_data(*self.pyramid.query(left, right, self.width(), self.method))
+        self.ax.figure.canvas.draw_idle()
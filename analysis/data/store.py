@@ -0,0 +1,256 @@
+'''
+Local telemetry store for decoded datalogger logs. Each signal is kept in its own folder, split into chunks of
+CHUNK_MILLIS of time, with an index of the time range of every chunk. Queries only read the chunks they overlap,
+so pulling an hour of a few signals out of many days of data doesn't read the rest of the archive.
+
+To build or update a store from a folder decoded by DataloggerDecoder.py:
+    cd analysis/data
+    python3 store.py -i datalogger_fsgp2022_day1/decoded -o telemetry
+
+Then in python:
+    store = TelemetryStore("data/telemetry")
+    signals = store.query(["0x703.vehicle_velocity", "0x702"], start=datetime(2022, 7, 5, 15), end=datetime(2022, 7, 5, 16))
+
+Some signals (ROLLUP_SIGNALS) also keep rollups: their count, sum, min, max and integral over every second, 10 seconds and minute,
+updated as logs are added. Summaries come from those instead of the samples:
+    store.aggregate("0x702.bus_power", [datetime(2022, 7, 5, 15), datetime(2022, 7, 5, 16)])    #energy used from 3 to 4pm in J
+    store.rollups("0x703.vehicle_velocity", 60000, start, end)                                    #mean speed every minute
+    store.aggregate("0x703.vehicle_velocity", telemetry.lap_starts(...))                          #per lap
+'''
+
+import numpy as np
+import os, sys
+import json
+import shutil
+import argparse
+from datetime import datetime
+from tqdm import tqdm
+
+dir = os.path.dirname(__file__)
+sys.path.insert(0, dir+'/..')   #allow imports from parent directory "analysis"
+
+from data.DataloggerDecoder import load_decoded, read_manifest
+from data.telemetry import ROLLUP, rollup, merge_rollups, combine_rollups, rollup_frame
+
+CHUNK_MILLIS = 3600 * 1000  #1 hour of data per chunk file
+INDEX = "index.json"
+ROLLUP_INTERVALS = [1000, 10000, 60000]     #millis
+ROLLUP_SIGNALS = [
+    "0x703.vehicle_velocity", "0x702.bus_voltage_of_mc", "0x702.bus_current_drawn_by_mc", "0x702.bus_power",
+    "0x230.pack_voltage", "0x232.pack_current", "0x70B.motor_temp", "0x233.max_temp",
+]
+#signals made by multiplying two signals of the same CAN message, when both are added
+DERIVED = {"0x702.bus_power": ("0x702.bus_voltage_of_mc", "0x702.bus_current_drawn_by_mc")}     #W
+
+
+def to_millis(t):
+    '''Unix millis from a datetime or pandas Timestamp, or a number that's already unix millis'''
+    return t.timestamp() * 1000 if isinstance(t, datetime) else t
+
+
+class TelemetryStore():
+    '''
+    Folder of signals from decoded logs, split by signal and time chunk. Signals are named like in load_decoded
+    ("0x702.bus_current_drawn_by_mc"). Fill it with update (or add), and read it with query.
+    '''
+
+    def __init__(self, path:str, chunk_millis=CHUNK_MILLIS):
+        self.path = path
+        index_file = os.path.join(path, INDEX)
+        if os.path.exists(index_file):
+            with open(index_file) as fp:
+                self.index = json.load(fp)
+        else:
+            #"chunks" is signal -> chunk number -> [first millis, last millis, samples], "sources" is decoded file -> version added
+            self.index = {"chunk_millis": chunk_millis, "chunks": {}, "sources": {}}
+        self.chunk_millis = self.index["chunk_millis"]
+        if "rollups" not in self.index:
+            #"rollups" is the signals that have rollups and their intervals. Stores made before rollups get them now
+            self.index["rollups"] = {"signals": ROLLUP_SIGNALS, "intervals": ROLLUP_INTERVALS}
+            self.rebuild_rollups()
+
+    @property
+    def signals(self):
+        return sorted(self.index["chunks"])
+
+    def _chunk_files(self, signal, chunk):
+        folder = os.path.join(self.path, signal)
+        return os.path.join(folder, f"{chunk}.millis.npy"), os.path.join(folder, f"{chunk}.values.npy")
+
+    def _rollup_file(self, signal, interval):
+        return os.path.join(self.path, "rollups", str(interval), f"{signal}.bin")
+
+    def _save_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        index_file = os.path.join(self.path, INDEX)
+        with open(index_file + ".tmp", "w") as fp:
+            json.dump(self.index, fp, indent=1)
+        os.replace(index_file + ".tmp", index_file)
+
+    def add(self, signals:dict):
+        '''
+        Add samples to the store. signals is a dict of signal name -> (millis, values), like load_decoded returns.
+        Samples are merged into the chunks they fall in, keeping each chunk sorted by time. DERIVED signals are added too,
+        and the rollups of ROLLUP_SIGNALS are updated.
+        '''
+        signals = dict(signals)
+        for derived, (a, b) in DERIVED.items():
+            if a in signals and b in signals and np.array_equal(signals[a][0], signals[b][0]):
+                signals[derived] = (signals[a][0], signals[a][1].astype(float) * signals[b][1])
+
+        for signal, (millis, values) in signals.items():
+            order = np.argsort(millis, kind='stable')
+            millis, values = millis[order], values[order]
+            chunk_ids = millis // self.chunk_millis
+            bounds = np.flatnonzero(np.diff(chunk_ids)) + 1
+            signal_chunks = self.index["chunks"].setdefault(signal, {})
+            os.makedirs(os.path.join(self.path, signal), exist_ok=True)
+
+            for chunk_millis, chunk_values in zip(np.split(millis, bounds), np.split(values, bounds)):
+                chunk = str(int(chunk_millis[0] // self.chunk_millis))
+                millis_file, values_file = self._chunk_files(signal, chunk)
+                if chunk in signal_chunks:
+                    chunk_millis = np.concatenate([np.load(millis_file), chunk_millis])
+                    chunk_values = np.concatenate([np.load(values_file), chunk_values])
+                    order = np.argsort(chunk_millis, kind='stable')
+                    chunk_millis, chunk_values = chunk_millis[order], chunk_values[order]
+                np.save(millis_file, chunk_millis)
+                np.save(values_file, chunk_values)
+                signal_chunks[chunk] = [int(chunk_millis[0]), int(chunk_millis[-1]), len(chunk_millis)]
+            if signal in self.index["rollups"]["signals"]:
+                self._add_rollups(signal, millis, values)
+        self._save_index()
+
+    def _add_rollups(self, signal, millis, values):
+        '''Merge the rollups of new samples into the rollup files, which hold ROLLUP records sorted by start. Only the records from
+        the first new bucket on are rewritten, so adding logs in time order just appends'''
+        if values.ndim != 1 or len(millis) == 0:
+            return
+        for interval in self.index["rollups"]["intervals"]:
+            new = rollup(millis, values, interval)
+            file = self._rollup_file(signal, interval)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, "ab+") as fp:
+                fp.seek(0)
+                starts = np.fromfile(fp, dtype=ROLLUP)["start"]
+                first = np.searchsorted(starts, new["start"][0], side='left')
+                fp.seek(first * ROLLUP.itemsize)
+                merged = merge_rollups(np.fromfile(fp, dtype=ROLLUP), new)
+                fp.truncate(first * ROLLUP.itemsize)
+                fp.write(merged.tobytes())
+
+    def rebuild_rollups(self):
+        '''Make the rollups of index["rollups"]["signals"] again from the stored samples, eg. after changing which signals have rollups'''
+        shutil.rmtree(os.path.join(self.path, "rollups"), ignore_errors=True)
+        for signal in self.index["rollups"]["signals"]:
+            if signal in self.index["chunks"]:
+                self._add_rollups(signal, *self.query([signal])[signal])
+        if self.index["chunks"]:
+            self._save_index()
+
+    def update(self, decoded_folder:str):
+        '''
+        Add the logs in a folder decoded by DataloggerDecoder.decode_folder that aren't in the store yet, using its manifest.
+        If a log that's already in the store was decoded again or removed, the store is rebuilt from the folder.
+        Returns the number of decoded files that were added.
+        '''
+        sources = {entry["output"]: f'{entry["sha1"]}:{entry["decoder"]}:{entry["canDef"]}'
+                   for entry in read_manifest(decoded_folder).values() if entry["output"] and entry["output"].endswith(".npz")}
+        if any(sources.get(output) != version for output, version in self.index["sources"].items()):
+            self.clear()
+
+        new = sorted(output for output in sources if output not in self.index["sources"])
+        parts = {}
+        for output in tqdm(new):
+            for signal, part in load_decoded(os.path.join(decoded_folder, output)).items():
+                parts.setdefault(signal, []).append(part)
+        self.add({signal: (np.concatenate([p[0] for p in signal_parts]), np.concatenate([p[1] for p in signal_parts]))
+                  for signal, signal_parts in parts.items()})
+
+        for output in new:
+            self.index["sources"][output] = sources[output]
+        self._save_index()
+        return len(new)
+
+    def clear(self):
+        '''Delete everything in the store'''
+        for signal in self.index["chunks"]:
+            shutil.rmtree(os.path.join(self.path, signal), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.path, "rollups"), ignore_errors=True)
+        self.index["chunks"] = {}
+        self.index["sources"] = {}
+        self._save_index()
+
+    def query(self, signals:list, start=None, end=None):
+        '''
+        Samples of some signals between start (inclusive) and end (exclusive), as unix millis or datetimes. signals are
+        signal names, or CAN ids like "0x702" for all of an id's signals. Only the chunks in [start, end) are read.
+        Returns a dict of signal name -> (millis, values) sorted by time, like load_decoded.
+        '''
+        start = -np.inf if start is None else to_millis(start)
+        end = np.inf if end is None else to_millis(end)
+        names = [s for s in self.index["chunks"] if s in signals or s.split(".", 1)[0] in signals]
+
+        results = {}
+        for signal in names:
+            millis_parts = []
+            values_parts = []
+            for chunk, (first, last, _) in sorted(self.index["chunks"][signal].items(), key=lambda item: int(item[0])):
+                if last < start or first >= end:
+                    continue
+                millis_file, values_file = self._chunk_files(signal, chunk)
+                millis = np.load(millis_file, mmap_mode='r')
+                lo = np.searchsorted(millis, start, side='left') if first < start else 0
+                hi = np.searchsorted(millis, end, side='left') if last >= end else len(millis)
+                millis_parts.append(np.array(millis[lo:hi]))
+                values_parts.append(np.array(np.load(values_file, mmap_mode='r')[lo:hi]))
+
+            if millis_parts:
+                results[signal] = (np.concatenate(millis_parts), np.concatenate(values_parts))
+        return results
+
+    def _read_rollups(self, signal, interval, start=-np.inf, end=np.inf):
+        file = self._rollup_file(signal, interval)
+        if signal not in self.index["rollups"]["signals"] or interval not in self.index["rollups"]["intervals"]:
+            raise KeyError(f"no {interval} ms rollups of {signal}")
+        if not os.path.exists(file) or os.path.getsize(file) == 0:
+            return np.zeros(0, dtype=ROLLUP)
+        records = np.memmap(file, dtype=ROLLUP, mode='r')
+        return np.array(records[np.searchsorted(records["start"], start, side='left'):np.searchsorted(records["start"], end, side='left')])
+
+    def rollups(self, signal, interval=ROLLUP_INTERVALS[0], start=None, end=None):
+        '''
+        Rollups of a signal every interval millis (one of ROLLUP_INTERVALS) that start between start and end (unix millis or datetimes).
+        Returns a DataFrame with the start (unix millis), count, sum, min, max, mean and integral (value * seconds) of each interval
+        with samples, indexed by local datetime.
+        '''
+        start = -np.inf if start is None else to_millis(start)
+        end = np.inf if end is None else to_millis(end)
+        return rollup_frame(self._read_rollups(signal, interval, start, end))
+
+    def aggregate(self, signal, edges):
+        '''
+        Summarize a signal over the intervals [edges[i], edges[i+1]) (unix millis or datetimes), eg. a day, or laps from telemetry.lap_starts,
+        from its rollups: the coarsest ones that line up with every edge, so edges are rounded down to the second at worst.
+        Returns a DataFrame like rollups with a row per interval.
+        '''
+        edges = np.array([to_millis(edge) for edge in edges], dtype=np.int64)
+        intervals = sorted(self.index["rollups"]["intervals"])
+        interval = max([i for i in intervals if np.all(edges % i == 0)], default=intervals[0])
+        edges = edges // interval * interval
+        return rollup_frame(combine_rollups(self._read_rollups(signal, interval, edges[0], edges[-1]), edges))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add decoded data logger logs to a telemetry store')
+    parser.add_argument("-i", "--input", type=str, required=True, help='folder decoded by DataloggerDecoder.py')
+    parser.add_argument("-o", "--output", type=str, required=True, help='telemetry store folder')
+    args = parser.parse_args()
+
+    store = TelemetryStore(args.output)
+    added = store.update(args.input)
+    print(f"added {added} logs, {len(store.signals)} signals in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
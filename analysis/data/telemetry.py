@@ -0,0 +1,249 @@
+'''
+Tools for working with decoded telemetry: dicts of signal name -> (unix millis, values) like the ones returned by
+DataloggerDecoder.load_decoded and TelemetryStore.query.
+'''
+
+import numpy as np
+import time
+import pandas as pd
+
+AGGREGATIONS = ("mean", "min", "max", "sum", "count", "first", "last")
+
+
+def local_datetimes(millis):
+    '''Naive local datetimes for an array of unix millis, the same as datetime.fromtimestamp but vectorized'''
+    seconds = np.asarray(millis, dtype=float) / 1000.
+    hours, inverse = np.unique(np.floor(seconds / 3600), return_inverse=True)
+    offsets = np.array([time.localtime(hour * 3600).tm_gmtoff for hour in hours])   #daylight savings changes on the hour
+    return pd.DatetimeIndex(np.round((seconds + offsets[inverse.reshape(-1)]) * 1000).astype(np.int64).astype("datetime64[ms]"))
+
+
+def _interp(millis, values, times, max_gap):
+    out = np.interp(times, millis, values, left=np.nan, right=np.nan)
+    if max_gap is not None:
+        after = np.clip(np.searchsorted(millis, times, side='right'), 1, len(millis) - 1)
+        out[millis[after] - millis[after - 1] > max_gap] = np.nan
+    return out
+
+
+def _hold(millis, values, times, max_gap):
+    last = np.searchsorted(millis, times, side='right') - 1
+    out = values[np.maximum(last, 0)]
+    stale = (last < 0) if max_gap is None else (last < 0) | (times - millis[np.maximum(last, 0)] > max_gap)
+    out[stale] = np.nan
+    return out
+
+
+def _aggregate(millis, values, edges, how):
+    '''Aggregate the samples in each interval [edges[i], edges[i+1])'''
+    starts = np.searchsorted(millis, edges[:-1], side='left')
+    stops = np.searchsorted(millis, edges[1:], side='left')
+    counts = stops - starts
+    if how == "count":
+        return counts
+    full = counts > 0
+    out = np.full(len(counts), np.nan)
+    if not full.any():
+        return out
+
+    if how in ("sum", "mean"):
+        sums = np.concatenate([[0], np.cumsum(values)])
+        out[full] = sums[stops[full]] - sums[starts[full]]
+        if how == "mean":
+            out[full] /= counts[full]
+    elif how == "first":
+        out[full] = values[starts[full]]
+    elif how == "last":
+        out[full] = values[stops[full] - 1]
+    else:
+        #intervals are back to back, so each non empty one runs until the next non empty one starts
+        first, last = starts[full][0], stops[full][-1]
+        ufunc = np.minimum if how == "min" else np.maximum
+        out[full] = ufunc.reduceat(values[first:last], starts[full] - first)
+    return out
+
+
+def resample(signals:dict, specs:list, timebase=None, rate=None, start=None, end=None, max_gap=None):
+    '''
+    Align several signals to one timebase. signals is a dict of signal name -> (millis, values) like load_decoded returns.
+    specs is a list of (column, signal) or (column, signal, method), eg. ("speed", "0x703.vehicle_velocity", "interp"). Methods:
+        "interp": linear interpolation (the default)
+        "hold": the last sample at or before each time, for states and flags
+        "mean", "min", "max", "sum", "count", "first", "last": aggregate the samples from each time to the next one
+    The timebase is an array of unix millis, or one every 1/rate seconds from start to end (unix millis), which default to
+    the time range covered by all the signals. Times more than max_gap millis from a sample are NaN for interp and hold.
+    Returns a DataFrame with a column per spec and a "timestamp" column (unix seconds), indexed by local datetime ("date").
+    '''
+    specs = [spec if len(spec) == 3 else (*spec, "interp") for spec in specs]
+    for column, signal, method in specs:
+        if method not in ("interp", "hold") + AGGREGATIONS:
+            raise ValueError(f"unknown resample method {method} for {column}")
+
+    if timebase is None:
+        if rate is None:
+            raise ValueError("resample needs a timebase or a rate")
+        start = max(signals[signal][0][0] for _, signal, _ in specs) if start is None else start
+        end = min(signals[signal][0][-1] for _, signal, _ in specs) if end is None else end
+        timebase = np.arange(start, end, 1000. / rate)
+    timebase = np.asarray(timebase, dtype=float)
+    step = timebase[-1] - timebase[-2] if len(timebase) > 1 else 1000. / (rate or 1)
+    edges = np.append(timebase, timebase[-1] + step) if len(timebase) else timebase
+
+    columns = {"timestamp": timebase / 1000.}
+    for column, signal, method in specs:
+        millis, values = signals[signal]
+        millis = np.asarray(millis, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if len(timebase) == 0 or len(millis) == 0:
+            columns[column] = np.full(len(timebase), np.nan)
+        elif method == "interp":
+            columns[column] = _interp(millis, values, timebase, max_gap)
+        elif method == "hold":
+            columns[column] = _hold(millis, values, timebase, max_gap)
+        else:
+            columns[column] = _aggregate(millis, values, edges, method)
+
+    resampled = pd.DataFrame(columns, index=local_datetimes(timebase))
+    resampled.index.name = "date"
+    return resampled
+
+
+def integrate_speed(millis, speeds, max_gap=None):
+    '''
+    Distance (m) travelled at each sample from integrating speed (m/s) over time with the trapezoid rule, starting at 0.
+    Intervals longer than max_gap millis, like the time between two logs, add no distance.
+    '''
+    millis = np.asarray(millis, dtype=float)
+    speeds = np.asarray(speeds, dtype=float)
+    dts = np.diff(millis) / 1000.
+    steps = (speeds[1:] + speeds[:-1]) / 2 * dts
+    if max_gap is not None:
+        steps[dts * 1000. > max_gap] = 0
+    return np.concatenate([[0.], np.cumsum(steps)])
+
+
+def stitch_odometer(millis, dists, threshold=1., speed=None, max_gap=None):
+    '''
+    Make odometer readings (like "0x70E.odometer", m) that go back to 0 when the car is power cycled into one increasing distance.
+    A reset is a reading more than threshold meters less than the one before it; everything after it is shifted up by the
+    reading before the reset. speed is an optional (millis, speeds) signal to check the odometer against.
+    Returns a dict with the stitched 'dist' and the indices of the 'resets'. With speed, also 'speed_dist', the distance from
+    integrate_speed (with max_gap) at the odometer's times starting from the first stitched distance, and the 'drift' dist - speed_dist.
+    '''
+    millis = np.asarray(millis, dtype=float)
+    dists = np.asarray(dists, dtype=float)
+    resets = np.flatnonzero(dists[1:] < dists[:-1] - threshold) + 1
+    offsets = np.zeros_like(dists)
+    offsets[resets] = dists[resets - 1]
+    stitched = {'dist': dists + np.cumsum(offsets), 'resets': resets}
+
+    if speed is not None:
+        speed_millis, speeds = speed
+        integrated = integrate_speed(speed_millis, speeds, max_gap)
+        speed_dist = np.interp(millis, np.asarray(speed_millis, dtype=float), integrated)
+        speed_dist += stitched['dist'][0] - speed_dist[0] if len(dists) else 0
+        stitched['speed_dist'] = speed_dist
+        stitched['drift'] = stitched['dist'] - speed_dist
+    return stitched
+
+
+def segment_sessions(millis, speeds, min_speed=0.5, min_stop=300000, max_gap=60000):
+    '''
+    Split samples into driving sessions: stretches where the car is moving (speed >= min_speed m/s), separated by stops longer than
+    min_stop millis or by gaps longer than max_gap millis with no samples at all. Short stops within a session belong to it.
+    Returns an array with the session number (0, 1, ...) of each sample, -1 while stopped between sessions, and a DataFrame
+    with the "start" and "end" millis and the number of "samples" of each session.
+    '''
+    millis = np.asarray(millis, dtype=float)
+    moving = np.flatnonzero(np.asarray(speeds) >= min_speed)
+    sessions = np.full(len(millis), -1)
+    if len(moving) == 0:
+        return sessions, pd.DataFrame({"start": [], "end": [], "samples": []})
+
+    #a new session starts at a moving sample if the car was stopped too long since the last one, or data is missing in between
+    gaps = np.concatenate([[0], np.cumsum(np.diff(millis) > max_gap)])
+    new = np.concatenate([[True], (np.diff(millis[moving]) > min_stop) | (np.diff(gaps[moving]) > 0)])
+    moving_sessions = np.cumsum(new) - 1
+
+    #samples between two moving samples of the same session belong to it
+    position = np.searchsorted(moving, np.arange(len(millis)), side='right') - 1    #last moving sample at or before each sample
+    before = moving_sessions[np.maximum(position, 0)]
+    after = moving_sessions[np.minimum(position + 1, len(moving) - 1)]
+    inside = (position >= 0) & ((before == after) | (moving[np.maximum(position, 0)] == np.arange(len(millis))))
+    sessions[inside] = before[inside]
+
+    starts = moving[new]
+    ends = moving[np.append(np.flatnonzero(new)[1:] - 1, len(moving) - 1)]
+    table = pd.DataFrame({"start": millis[starts], "end": millis[ends], "samples": ends - starts + 1})
+    return sessions, table
+
+
+def lap_starts(millis, dists, lap_length, offset=0.):
+    '''Millis of the first sample of each lap around a closed track, from increasing distances (m, eg. from stitch_odometer) with laps starting at offset'''
+    laps = np.floor((np.asarray(dists, dtype=float) - offset) / lap_length)
+    return np.asarray(millis)[np.flatnonzero(np.diff(laps) > 0) + 1]
+
+
+#aggregates of the samples in a time bucket starting at "start" (unix millis). integral is the sum of value * seconds to the next sample
+ROLLUP = np.dtype([("start", "<i8"), ("count", "<i8"), ("sum", "<f8"), ("min", "<f8"), ("max", "<f8"), ("integral", "<f8")])
+
+
+def rollup(millis, values, interval, max_gap=2000):
+    '''
+    Aggregate samples (millis sorted) into buckets of interval millis. Returns ROLLUP records for the buckets that have samples.
+    A sample counts in the integral until the next one, or not at all if that's more than max_gap millis later, so the integral
+    of power (W) is energy (J). NaNs are left out.
+    '''
+    millis = np.asarray(millis, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+    dts = np.diff(millis, append=millis[-1:]) if len(millis) else millis
+    dts = np.where(dts > max_gap, 0, dts) / 1000.
+    keep = ~np.isnan(values)
+    millis, values, dts = millis[keep], values[keep], dts[keep]
+
+    buckets = millis // interval * interval
+    starts = np.flatnonzero(np.diff(buckets, prepend=buckets[:1] - 1)) if len(buckets) else buckets
+    records = np.zeros(len(starts), dtype=ROLLUP)
+    if len(starts) == 0:
+        return records
+    records["start"] = buckets[starts]
+    records["count"] = np.diff(starts, append=len(buckets))
+    records["sum"] = np.add.reduceat(values, starts)
+    records["min"] = np.minimum.reduceat(values, starts)
+    records["max"] = np.maximum.reduceat(values, starts)
+    records["integral"] = np.add.reduceat(values * dts, starts)
+    return records
+
+
+def combine_rollups(records, edges):
+    '''Combine ROLLUP records (sorted by start) into the intervals [edges[i], edges[i+1]). Intervals with no records have a count of 0 and NaN min and max'''
+    edges = np.asarray(edges, dtype=np.int64)
+    combined = np.zeros(max(len(edges) - 1, 0), dtype=ROLLUP)
+    combined["start"] = edges[:-1]
+    for field, how in [("count", "sum"), ("sum", "sum"), ("integral", "sum"), ("min", "min"), ("max", "max")]:
+        aggregated = _aggregate(records["start"], records[field], edges, how)
+        combined[field] = aggregated if how != "sum" else np.nan_to_num(aggregated)
+    return combined
+
+
+def merge_rollups(*parts):
+    '''Merge ROLLUP records with the same interval (eg. existing ones and ones from new samples) into one sorted array with a record per bucket'''
+    records = np.concatenate(parts)
+    records = records[np.argsort(records["start"], kind='stable')]
+    if len(records) == 0:
+        return records
+    starts = np.flatnonzero(np.diff(records["start"], prepend=records["start"][:1] - 1))
+    merged = records[starts].copy()
+    for field, ufunc in [("count", np.add), ("sum", np.add), ("integral", np.add), ("min", np.fmin), ("max", np.fmax)]:
+        merged[field] = ufunc.reduceat(records[field], starts)
+    return merged
+
+
+def rollup_frame(records):
+    '''DataFrame of ROLLUP records with a mean column, indexed by the local datetime of each start ("date") like resample'''
+    frame = pd.DataFrame(records)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frame["mean"] = frame["sum"] / frame["count"]
+    frame.index = local_datetimes(records["start"])
+    frame.index.name = "date"
+    return frame
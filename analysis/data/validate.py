@@ -0,0 +1,182 @@
+'''
+Checks the simulator's motor power model (simulator.raceEnv.motor_power) against real drives. Telemetry is resampled
+like in carfit.py, then the power every car predicts for every sample is computed in one batch and compared with the
+measured volt * current: residuals by speed, grade and acceleration, and how far the cumulative energy drifts over each session.
+
+To compare some cars in cars/ on decoded logs:
+    python3 analysis/data/validate.py -i analysis/data/datalogger_fsgp2022_day1/decoded --cars brizo_fsgp22 brizo_fit
+With the grade of each sample looked up from the odometer's distance around a closed track:
+    python3 analysis/data/validate.py -i analysis/data/datalogger_fsgp2022_day1/decoded --track analysis/data/datalogger_fsgp2022_day1/heartland_track.csv
+'''
+
+import numpy as np
+import pandas as pd
+import os, sys
+import json
+import argparse
+
+dir = os.path.dirname(__file__)
+sys.path.insert(0, dir+'/..')       #allow imports from "analysis"
+sys.path.insert(0, dir+'/../..')    #and from the repository root
+
+from data.carfit import CARS_DIR, FIT_SIGNALS, fit_samples, fit_mask, iter_decoded
+from data.telemetry import stitch_odometer
+from simulator.raceEnv import motor_power
+from util import haversine
+
+ODOMETER_SIGNAL = "0x70E.odometer"
+
+SPEED_BANDS = [0, 5, 10, 15, 20, 25, 30]                       #m/s
+GRADE_BANDS = [-np.inf, -2, -1, -0.25, 0.25, 1, 2, np.inf]      #percent
+ACCEL_BANDS = [-np.inf, -0.5, -0.1, 0.1, 0.5, np.inf]           #m/s^2
+
+
+def load_cars(cars:list):
+    '''Car properties for a list of car names in cars/ or dicts like them. Returns a dict of name -> properties'''
+    loaded = {}
+    for i, car in enumerate(cars):
+        if isinstance(car, str):
+            with open(f"{CARS_DIR}/{car}.json") as fp:
+                loaded[car] = json.load(fp)
+        else:
+            loaded[car.get("name", f"car{i}")] = car
+    return loaded
+
+
+def read_track(path:str):
+    '''
+    Distances (m) and slopes (radians) of the points of one lap in a track csv like heartland_track.csv (made by
+    analysis_fsgp2022_1.ipynb), and the lap length (m), which includes the way from the last point back to the first
+    '''
+    track = pd.read_csv(path)
+    dists = track["dist"].to_numpy()
+    closing = haversine(track["latitude"].iloc[-1], track["longitude"].iloc[-1], track["latitude"].iloc[0], track["longitude"].iloc[0])
+    return dists, track["slope"].to_numpy(), dists[-1] + closing
+
+
+def load_samples(chunks, track=None, offset=0., **kwargs):
+    '''
+    Concatenate carfit.fit_samples of chunks of telemetry, numbering sessions across all of them. kwargs go to fit_samples.
+    track is (distances, slopes, lap length) from read_track. With it, chunks need ODOMETER_SIGNAL too, and the sinslope
+    of each sample comes from its odometer distance around the track, where the odometer read offset meters at the first point
+    (see lap_sinslope). Readings are only stitched across power cycles within a chunk (see telemetry.stitch_odometer).
+    '''
+    if track is not None:
+        kwargs["extra"] = kwargs.get("extra", []) + [("dist", ODOMETER_SIGNAL, "interp")]
+    parts = []
+    sessions = 0
+    for signals in chunks:
+        samples = fit_samples(signals, **kwargs)
+        if samples is None:
+            continue
+        if track is not None:
+            samples["dist"] = stitch_odometer(samples["timestamp"].to_numpy() * 1000, samples["dist"].to_numpy())["dist"]
+            samples["sinslope"] = lap_sinslope(samples["dist"].to_numpy(), *track, offset)
+        moving = samples["session"] >= 0
+        samples.loc[moving, "session"] += sessions
+        sessions = samples["session"].max() + 1 if moving.any() else sessions
+        parts.append(samples)
+    return pd.concat(parts)
+
+
+def lap_sinslope(dists, track_dists, track_slopes, lap_length, offset=0.):
+    '''sin of the grade at distances (m) around a closed track, given slopes (radians) at distances along one lap starting at offset'''
+    return np.interp((np.asarray(dists) - offset) % lap_length, track_dists, np.sin(track_slopes), period=lap_length)
+
+
+def banded(residuals, values, edges):
+    '''Number, mean (bias) and RMS of each car's residuals (cars, samples) in each band between edges of values, as (cars, bands) arrays'''
+    k = len(residuals)
+    bands = np.digitize(values, edges) - 1
+    inside = (bands >= 0) & (bands < len(edges) - 1)
+    nb = len(edges) - 1
+    index = (np.arange(k)[:, None] * nb + bands[None, inside]).ravel()
+    counts = np.bincount(index, minlength=k*nb).reshape(k, nb)
+    sums = np.bincount(index, weights=residuals[:, inside].ravel(), minlength=k*nb).reshape(k, nb)
+    squares = np.bincount(index, weights=(residuals[:, inside]**2).ravel(), minlength=k*nb).reshape(k, nb)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts, sums / counts, np.sqrt(squares / counts)
+
+
+def validate_cars(samples:pd.DataFrame, cars:list, speed_bands=SPEED_BANDS, grade_bands=GRADE_BANDS, accel_bands=ACCEL_BANDS, **filters):
+    '''
+    Compare the motor power of cars (names in cars/ or dicts, see load_cars) with telemetry samples from load_samples.
+    Residuals (predicted - measured W) are taken on the samples selected by carfit.fit_mask (with filters). Energy drift uses every
+    moving sample of a session, with predictions clipped to each car's motor power limits.
+    Returns a dict of DataFrames:
+        'summary': per car RMSE, bias and R^2 of power, and total measured and predicted watt-hours
+        'speed', 'grade', 'accel': per (car, band) samples, bias and RMSE
+        'drift': per (car, session) measured and predicted watt-hours, their difference, and the largest difference at any time
+    '''
+    cars = load_cars(cars)
+    names = list(cars)
+    props = {key: np.array([[car[key]] for car in cars.values()], dtype=float)
+             for key in ['P_drag', 'P_fric', 'P_accel', 'mass', 'max_motor_output_power', 'max_motor_input_power']}
+
+    speeds = samples["speed"].to_numpy()
+    accels = samples["accel"].to_numpy()
+    sinslopes = samples["sinslope"].to_numpy()
+    powers = samples["power"].to_numpy()
+    predicted = motor_power(props, accels, speeds, 0, sinslopes)   #(cars, samples)
+
+    fit = fit_mask(samples, **filters)
+    residuals = predicted[:, fit] - powers[fit]
+    bias = residuals.mean(axis=1)
+    rmse = np.sqrt((residuals**2).mean(axis=1))
+    r_squared = 1 - (residuals**2).sum(axis=1) / ((powers[fit] - powers[fit].mean())**2).sum()
+
+    results = {}
+    for key, values, edges in [("speed", speeds[fit], speed_bands), ("grade", sinslopes[fit] * 100, grade_bands), ("accel", accels[fit], accel_bands)]:
+        counts, band_bias, band_rmse = banded(residuals, values, edges)
+        labels = [f"{lo:g} to {hi:g}" for lo, hi in zip(edges[:-1], edges[1:])]
+        results[key] = pd.DataFrame({"samples": counts.ravel(), "bias": band_bias.ravel(), "rmse": band_rmse.ravel()},
+                                    index=pd.MultiIndex.from_product([names, labels], names=["car", key]))
+
+    #energy of each session, integrating power over the time to the next sample
+    moving = ((samples["session"] >= 0) & np.isfinite(samples[["speed", "accel", "power", "sinslope"]]).all(axis=1)).to_numpy()
+    sessions = samples["session"].to_numpy()[moving]
+    dts = np.diff(samples["timestamp"].to_numpy(), append=np.nan)[moving]
+    dts = np.where(np.isfinite(dts) & (dts < 2), dts, 0)
+    clipped = np.clip(predicted[:, moving], props['max_motor_input_power'], props['max_motor_output_power'])
+    session_ids, session_index = np.unique(sessions, return_inverse=True)
+    measured_wh = np.bincount(session_index, weights=powers[moving] * dts, minlength=len(session_ids)) / 3600.
+    predicted_wh = np.stack([np.bincount(session_index, weights=p * dts, minlength=len(session_ids)) for p in clipped]) / 3600.
+    #largest cumulative difference at any point in each session (sessions are numbered in time order, so each is one run of samples)
+    cumulative = np.cumsum((clipped - powers[moving]) * dts, axis=1) / 3600.
+    starts = np.flatnonzero(np.diff(session_index, prepend=-1))
+    before = np.concatenate([np.zeros((len(names), 1)), cumulative[:, starts[1:] - 1]], axis=1)
+    max_drift_wh = np.maximum.reduceat(np.abs(cumulative - np.repeat(before, np.diff(starts, append=len(session_index)), axis=1)), starts, axis=1)
+    results["drift"] = pd.DataFrame({
+        "measured_wh": np.tile(measured_wh, len(names)),
+        "predicted_wh": predicted_wh.ravel(),
+        "drift_wh": (predicted_wh - measured_wh).ravel(),
+        "max_drift_wh": max_drift_wh.ravel(),
+    }, index=pd.MultiIndex.from_product([names, session_ids], names=["car", "session"]))
+
+    results["summary"] = pd.DataFrame({
+        "rmse": rmse, "bias": bias, "r_squared": r_squared,
+        "measured_wh": measured_wh.sum(), "predicted_wh": predicted_wh.sum(axis=1),
+    }, index=pd.Index(names, name="car"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the motor power of simulated cars with decoded telemetry')
+    parser.add_argument("-i", "--input", type=str, nargs="+", required=True, help='folders of decoded .npz logs')
+    parser.add_argument("--cars", type=str, nargs="+", default=["brizo_fsgp22"], help='names of cars in cars/')
+    parser.add_argument("--track", type=str, default=None, help='track csv (see read_track) to take the grade from, instead of flat')
+    parser.add_argument("--offset", type=float, default=0., help='odometer reading (m) at the first point of --track')
+    args = parser.parse_args()
+
+    signals = [signal for _, signal, _ in FIT_SIGNALS]
+    track = None
+    if args.track:
+        track = read_track(args.track)
+        signals.append(ODOMETER_SIGNAL)
+    results = validate_cars(load_samples(iter_decoded(args.input, signals), track, args.offset), args.cars)
+    for key in ["speed", "grade", "accel", "drift", "summary"]:
+        print(results[key].round(2).to_string(), "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import numpy as np
+import os, sys
+
+dir = os.path.dirname(__file__)
+sys.path.insert(0, dir+'/..')   #allow imports from parent directory "onboarding22"
+
+from util import solar_position
+
+SOLAR_CONSTANT = 1353   #W/m^2 at the top of the atmosphere, used by the Meinel model
+DIFFUSE_FRACTION = 0.1  #clear sky diffuse irradiance as a fraction of direct normal irradiance
+
+def clearsky_irradiance(altitude):
+    '''
+    Clear sky irradiances (W/m^2) for arrays of solar altitude (radians), using Kasten-Young air mass
+    and the Meinel direct normal model. Returns (global horizontal, direct normal, diffuse). 0 when the sun is down.
+    '''
+    altitude = np.asarray(altitude, dtype=float)
+    up = altitude > 0
+    zenith_deg = 90 - np.degrees(np.where(up, altitude, np.pi/2))
+    cos_zenith = np.cos(np.radians(zenith_deg))
+    air_mass = 1 / (cos_zenith + 0.50572 * (96.07995 - zenith_deg)**-1.6364)
+
+    dni = np.where(up, SOLAR_CONSTANT * 0.7**(air_mass**0.678), 0)
+    dhi = DIFFUSE_FRACTION * dni
+    ghi = dni * cos_zenith + dhi
+    return ghi, dni, dhi
+
+def get_sun(latitude, longitude, timestamps):
+    '''
+    Clear sky sun_flat (horizontal array) and sun_tilt (array tilted towards the sun) in W/m^2, matching
+    the values that forecast.openmeteo.get_wind_solar gives. Inputs broadcast like util.solar_position.
+    '''
+    altitude, _ = solar_position(latitude, longitude, timestamps)
+    ghi, dni, dhi = clearsky_irradiance(altitude)
+    return ghi, dni + dhi
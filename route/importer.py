@@ -0,0 +1,146 @@
+'''
+Reads route legs from GPX and GeoJSON tracks, like ones exported from Google Maps, gpx.studio or a GPS logger, instead of the
+csv export that get_geography expects. Along track distance and heading come from the lat/longs (util.haversine and bearing,
+vectorized over every point), elevation is resampled onto a fixed distance grid and smoothed there, and grade is the gradient
+of the smoothed elevation. The geography dict is the same as get_geography's, so make_leg (and Route.add_leg and manifests)
+accept .gpx and .geojson files as the gps file of a leg.
+
+To read a track and print a summary of it:
+    python route/importer.py stage1_ckpt1.gpx
+'''
+
+import numpy as np
+import json
+import os, sys
+import xml.etree.ElementTree as ET     #not gpxpy: it builds an object per point, and a leg only needs lat/lon/ele as arrays
+from scipy.interpolate import interp1d
+from scipy.signal import savgol_filter
+
+dir = os.path.dirname(__file__)
+sys.path.insert(0, dir+'/..')   #allow imports from parent directory "onboarding22"
+
+from util import *
+
+DIST_STEP = 10.             #meters between points of the resampled leg
+SMOOTHING_METERS = 200.     #length of the elevation smoothing window
+TRACK_EXTENSIONS = ('.gpx', '.geojson')
+
+
+def read_gpx(path:str):
+    '''Name and lat/long/elevation arrays of every track point (or route point if there are no tracks) of a .gpx, in file order'''
+    root = ET.parse(path).getroot()
+    ns = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''     #an exact namespace is much faster than {*} per point
+    points = root.findall(f'.//{ns}trkpt') or root.findall(f'.//{ns}rtept')
+    assert len(points), f"no track or route points in {path}"
+
+    latitudes = np.array([point.get('lat') for point in points], dtype=float)
+    longitudes = np.array([point.get('lon') for point in points], dtype=float)
+    elevations = np.array([point.findtext(f'{ns}ele', 'nan') for point in points], dtype=float)
+
+    name = root.findtext(f'{ns}trk/{ns}name') or root.findtext(f'{ns}rte/{ns}name') or os.path.basename(path).split('.')[0]
+    return name, latitudes, longitudes, elevations
+
+
+def read_geojson(path:str):
+    '''Name and lat/long/elevation arrays of the LineStrings (joined in order) of a .geojson Feature, FeatureCollection or geometry'''
+    with open(path) as f:
+        data = json.load(f)
+
+    features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+    lines = []
+    name = None
+    for feature in features:
+        geometry = feature.get('geometry', feature)
+        if geometry['type'] == 'LineString':
+            lines.append(geometry['coordinates'])
+        elif geometry['type'] == 'MultiLineString':
+            lines.extend(geometry['coordinates'])
+        else:
+            continue
+        name = name or feature.get('properties', {}).get('name')
+    assert len(lines), f"no LineStrings in {path}"
+
+    #coordinates are [longitude, latitude] or [longitude, latitude, elevation]
+    coords = np.concatenate([np.array([c[:3] + [np.nan]*(3 - len(c[:3])) for c in line], dtype=float) for line in lines])
+    return name or os.path.basename(path).split('.')[0], coords[:, 1], coords[:, 0], coords[:, 2]
+
+
+def smooth(values, window:int, method="savgol"):
+    '''Smooth evenly spaced values over window points: "savgol" (quadratic Savitzky-Golay), "mean" (moving average) or None'''
+    window = window | 1
+    if window > len(values):
+        window = len(values) - 1 + len(values) % 2      #longest odd window that fits
+    if method is None or window < 3:
+        return values
+    elif method == "savgol":
+        return savgol_filter(values, window, polyorder=2, mode='interp')
+    elif method == "mean":
+        padded = np.pad(values, window // 2, mode='edge')
+        sums = np.cumsum(np.insert(padded, 0, 0.))
+        return (sums[window:] - sums[:-window]) / window
+    raise ValueError(f"unknown smoothing method {method}")
+
+
+def track_geography(name:str, latitudes, longitudes, elevations, dist_step=DIST_STEP, smoothing=SMOOTHING_METERS, method="savgol"):
+    '''
+    Geography dict of a leg (see get_geography) from arrays of lat/long (degrees) and elevation (m, NaN where missing) along it.
+    Everything is resampled every dist_step meters, and elevation is smoothed over smoothing meters with method (see smooth).
+    '''
+    latitudes, longitudes, elevations = np.asarray(latitudes, float), np.asarray(longitudes, float), np.asarray(elevations, float)
+    steps = haversine(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+    keep = np.insert(steps > 0, 0, True)        #repeated points would make distance not increase
+    latitudes, longitudes, elevations = latitudes[keep], longitudes[keep], elevations[keep]
+    point_dists = np.insert(np.cumsum(steps[keep[1:]]), 0, 0.)
+    length = point_dists[-1]
+    assert length > 0, f"{name} has no length"
+
+    if np.isnan(elevations).all():
+        elevations = np.zeros_like(elevations)
+    has_elevation = ~np.isnan(elevations)
+
+    dists = np.append(np.arange(0, length, dist_step), length)
+    lats = np.interp(dists, point_dists, latitudes)
+    lons = np.interp(dists, point_dists, longitudes)
+    altitudes = smooth(np.interp(dists, point_dists[has_elevation], elevations[has_elevation]), int(round(smoothing / dist_step)), method)
+    slopes = np.gradient(altitudes, dists) * 100
+    headings = bearing(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    headings = np.append(headings, headings[-1])
+
+    return {
+        'name': name,
+        'length': length,
+        'longitude': interp1d(dists, lons, fill_value="extrapolate"),
+        'latitude': interp1d(dists, lats, fill_value="extrapolate"),
+        'slope': interp1d(dists, slopes, fill_value="extrapolate"),
+        'altitude': interp1d(dists, altitudes, fill_value="extrapolate"),
+        'heading': interp1d(dists, headings, fill_value="extrapolate", kind='nearest'),     #nearest so headings don't sweep through 0-360
+    }
+
+
+def get_track_geography(path:str, **kwargs):
+    '''Geography dict of the leg in a .gpx or .geojson file. kwargs go to track_geography'''
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.gpx':
+        track = read_gpx(path)
+    elif extension == '.geojson':
+        track = read_geojson(path)
+    else:
+        raise ValueError(f"can't read {path}, expected one of {TRACK_EXTENSIONS}")
+    return track_geography(*track, **kwargs)
+
+
+def main():
+    import time
+
+    path = sys.argv[1]
+    start = time.time()
+    geo = get_track_geography(path)
+    seconds = time.time() - start
+    dists = np.arange(0, geo['length'], DIST_STEP)
+    altitudes = geo['altitude'](dists)
+    print(f"{geo['name']}: {meters2miles(geo['length']):.2f} miles read from {path} in {seconds:.3f}s")
+    print(f"altitude {altitudes.min():.0f} to {altitudes.max():.0f} m, climbing {np.sum(np.maximum(np.diff(altitudes), 0)):.0f} m, steepest grade {np.abs(geo['slope'](dists)).max():.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,10 @@ import numpy as np
 import pandas as pd
 from scipy.interpolate import LinearNDInterpolator, interp1d
 import pickle
+import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
@@ -13,6 +15,8 @@ dir = os.path.dirname(__file__)
 sys.path.insert(0, dir+'/..')   #allow imports from parent directory "onboarding22"
 
 from util import *
+from route.spatial import RouteIndex
+from route.importer import get_track_geography, TRACK_EXTENSIONS
 
 
 CHARGE_START_HOUR = 7   #battery taken out of impound
@@ -24,6 +28,8 @@ MORNING_CHARGE_HOURS = DRIVE_START_HOUR - CHARGE_START_HOUR
 EVENING_CHARGE_HOURS = CHARGE_STOP_HOUR - DRIVE_STOP_HOUR
 HOURS_NOT_DRIVING = (DRIVE_START_HOUR + 24) - DRIVE_STOP_HOUR
 
+DEFAULT_SPEEDLIMIT_MPH = 65     #used for legs that don't have a route book steps csv
+
 def get_geography(csv_path:str):
     df = pd.read_csv(csv_path)
 
@@ -64,7 +70,11 @@ def parse_steps(csv:str, keywords = ['SL ', 'Stop Sign', 'TURN']):
         Get an array of distances(m) where there the car must stop, and a lambda with input dist(m) and output speedlimit (m/s).
         Use bisect_left to get speed limit at particular distance:
         speedlimit = limits[bisect_left(dists, dist)-1]
+        If csv is None, there are no stops and the speed limit is DEFAULT_SPEEDLIMIT_MPH everywhere.
         '''
+        if csv is None:
+            return np.array([]), (np.array([0.]), np.array([DEFAULT_SPEEDLIMIT_MPH * mph2mpersec()]))
+
         df = pd.read_csv(csv, skiprows=2) #first two rows of csv exported from Excel is weird
 
         #magic that gets all the rows that contain the keywords
@@ -82,6 +92,73 @@ def parse_steps(csv:str, keywords = ['SL ', 'Stop Sign', 'TURN']):
 
         return stop_dists, (limit_dists, limit_speeds)
 
+def make_leg(type:str, end:str, gps_csv:str, steps_csv:str, start:datetime, open:datetime, close:datetime):
+    '''
+    Build the dict of a base leg or loop. See Route.add_leg. Kept at module level so that legs can
+    be built in worker processes.
+    '''
+    assert type=='base' or type=='loop'
+    assert end=='checkpoint' or end=='stagestop'
+
+    if gps_csv.lower().endswith(TRACK_EXTENSIONS):
+        geo = get_track_geography(gps_csv)
+    else:
+        geo = get_geography(gps_csv)
+
+    stop_dists, speedlimit = parse_steps(csv=steps_csv)
+
+    #driving hours from start, not counting the nights before open and close
+    max_time = (close - start).total_seconds()/3600. - HOURS_NOT_DRIVING*(close.date() - start.date()).days
+    min_time = (open - start).total_seconds()/3600. - HOURS_NOT_DRIVING*(open.date() - start.date()).days
+
+    return {
+        'name': geo['name'],
+        'length': geo['length'],
+        'type': type,
+        'end': end,
+        'start': start,
+        'open': open,
+        'close': close,
+        'max_time': max_time,
+        'min_time': min_time,
+        'longitude': geo['longitude'],
+        'latitude': geo['latitude'],
+        'slope': geo['slope'],
+        'altitude': geo['altitude'],
+        'heading': geo['heading'],
+        'stop_dists': stop_dists,
+        'speedlimit': speedlimit,
+    }
+
+def read_manifest(manifest_path:str):
+    '''
+    Read a route manifest .json into a list of make_leg() keyword arguments, in race order.
+    File paths in the manifest are relative to the repository root.
+    Every leg must have start <= open <= close.
+    '''
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    time_format = '%Y-%m-%d %H:%M'
+    legs_kwargs = []
+    for entry in manifest['legs']:
+        legs_kwargs.append({
+            'type': entry['type'],
+            'end': entry['end'],
+            'gps_csv': dir + '/' + entry['gps'],
+            'steps_csv': None if entry.get('steps') is None else dir + '/' + entry['steps'],
+            'start': datetime.strptime(entry['start'], time_format),
+            'open': datetime.strptime(entry['open'], time_format),
+            'close': datetime.strptime(entry['close'], time_format),
+        })
+        leg = legs_kwargs[-1]
+        assert leg['start'] <= leg['open'], f"{entry['gps']} opens at {entry['open']}, before its start at {entry['start']}"
+        assert leg['open'] <= leg['close'], f"{entry['gps']} closes at {entry['close']}, before it opens at {entry['open']}"
+    return legs_kwargs
+
+def _make_leg_kwargs(kwargs):
+    return make_leg(**kwargs)
+
 class Route():
     def __init__(self):
         #list of dictionaries, each representing a leg
@@ -93,46 +170,63 @@ class Route():
             Add a dict to the route containing info of a base leg or loop. 
             Set type to 'base' or 'loop'. Set start to the first possible time that one can drive the leg,
             open to when the checkpoint/stagestop at the end of the leg opens, and close when one must 
-            finish the leg. 
+            finish the leg. Loops have no open time in the route book, so their open is their start. Set steps_csv to None if the leg has no route book steps.
+            gps_csv can also be a .gpx or .geojson track (see route/importer.py).
             Geographic data are interp1d objects. To get the slope at a distance d: leg_list\['slope'](d)
         '''
-        assert type=='base' or type=='loop'
-        assert end=='checkpoint' or end=='stagestop'
-
-        geo = get_geography(gps_csv)
-        self.total_length += geo['length']
-
-        stop_dists, speedlimit = parse_steps(csv=steps_csv)
-
-        num_days = close.day - start.day + 1      #number of days that the leg can span
-        max_time = (close - start).total_seconds()/3600. - HOURS_NOT_DRIVING*(num_days-1)
-        min_time = (open - start).total_seconds()/3600. - HOURS_NOT_DRIVING*(num_days-1)
-
-        leg = ({
-            'name': geo['name'],
-            'length': geo['length'],
-            'type': type,
-            'end': end,
-            'start': start,
-            'open': open,
-            'close': close,
-            'max_time': max_time,
-            'min_time': min_time,
-            'longitude': geo['longitude'],
-            'latitude': geo['latitude'],
-            'slope': geo['slope'],
-            'altitude': geo['altitude'],
-            'heading': geo['heading'],
-            'stop_dists': stop_dists,
-            'speedlimit': speedlimit,
-        })
+        leg = make_leg(type, end, gps_csv, steps_csv, start, open, close)
+        self.total_length += leg['length']
         self.leg_list.append(leg)
+        self.index = None       #rebuilt with the new leg the next time locate() is called
+
+    @staticmethod
+    def from_manifest(manifest_path:str, jobs=None):
+        '''
+        Build a route from every leg in a manifest .json (see route/asc2022/manifest.json).
+        Legs are read in parallel using up to jobs worker processes (default: number of cpus),
+        and are added to the route in manifest order.
+        '''
+        legs_kwargs = read_manifest(manifest_path)
+
+        print(f"\nBuilding {len(legs_kwargs)} legs from {manifest_path}")
+
+        route = Route()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for leg in executor.map(_make_leg_kwargs, legs_kwargs):
+                route.total_length += leg['length']
+                route.leg_list.append(leg)
+                print(f"Added \"{leg['name']}\"")
+        route.build_index()
+        return route
+
+    def build_index(self):
+        '''
+        Build the spatial indexes (KD-trees) of the full route and of each leg, used by locate().
+        They are saved with the route.
+        '''
+        self.index = RouteIndex(self.leg_list)
+        self.leg_indexes = [RouteIndex([leg]) for leg in self.leg_list]
+
+    def locate(self, latitude, longitude, leg=None):
+        '''
+        Find where on the route lat/long points are. Inputs can be scalars or arrays of millions of points.
+        Returns arrays (leg index, meters along the leg, cross-track error in meters).
+        Set leg to a leg index to only match against that leg.
+        '''
+        #no index yet (a leg was added, or the route was saved before indexes), or one saved before segments were put in the tree
+        if getattr(self, 'index', None) is None or not hasattr(self.index, 'tree_seg'):
+            self.build_index()
 
+        if leg is None:
+            return self.index.query(latitude, longitude)
+        leg_ids, dists, errs = self.leg_indexes[leg].query(latitude, longitude)
+        return np.full_like(leg_ids, leg), dists, errs
 
-    def gen_weather(self, start_leg=0, stop_leg=-1, dist_step=miles2meters(15)):
+    def gen_weather(self, start_leg=0, stop_leg=-1, dist_step=miles2meters(15), jobs=8):
         '''
         Generate 
         Weather data are 2D linear interpolants. To get the irradiance at a distance d and time t: leg_list\['solarradiance'](d, t)
+        Forecasts for every point of every leg are requested concurrently using jobs threads.
         '''
         import forecast.openmeteo
         
@@ -141,14 +235,35 @@ class Route():
 
         print(f"\nGenerating weather for legs {start_leg} to {stop_leg-1}")
 
-        for i in range(start_leg, stop_leg):
-            leg = self.leg_list[i]
-
-            #skip this leg if weather is already there
-            if('solar' in leg):
-                print(f"Weather exists for \"{leg['name']}\" ")
-                continue
-            print(f"Generating weather for \"{leg['name']}\" ")
+        def get_point_weather(leg, dist):
+            latitude = leg['latitude'](dist).item()
+            longitude = leg['longitude'](dist).item()
+            timestamps, wind_solars = forecast.openmeteo.get_wind_solar(latitude, longitude, leg['start'], leg['close'])
+            return timestamps, wind_solars
+
+        #request weather at points spaced dist_step meters apart for every leg at once
+        futures = {}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for leg_index in range(start_leg, stop_leg):
+                leg = self.leg_list[leg_index]
+
+                #skip this leg if weather is already there
+                if('sun_flat' in leg):
+                    print(f"Weather exists for \"{leg['name']}\" ")
+                    continue
+                print(f"Generating weather for \"{leg['name']}\" ")
+
+                dists = np.arange(0, leg['length']+dist_step, dist_step)
+                futures[leg_index] = [executor.submit(get_point_weather, leg, dist) for dist in dists]
+
+            #use tqdm loading bar
+            all_futures = [future for leg_futures in futures.values() for future in leg_futures]
+            for _ in tqdm(as_completed(all_futures), total=len(all_futures)):
+                pass
+
+        for leg_index, leg_futures in futures.items():
+            leg = self.leg_list[leg_index]
+            dists = np.arange(0, leg['length']+dist_step, dist_step)
 
             #(dist, time) points where weather is evaluated
             weather_pts = []
@@ -157,17 +272,9 @@ class Route():
             weather_vals = {}
             weather_vals['headwind'] = []
 
-            #get weather at points spaced dist_step meters apart, use tqdm loading bar
-            dists = np.arange(0, leg['length']+dist_step, dist_step)
-            for dist in tqdm(dists):
-
-                latitude = leg['latitude'](dist).item()
-                longitude = leg['longitude'](dist).item()
-
-                print(f"\n Getting weather at {round(dist)}m: ({round(latitude, 5)}, {round(longitude, 5)})")
-
-                #fill weather_pts and weather_vals
-                timestamps, wind_solars = forecast.openmeteo.get_wind_solar(latitude, longitude, leg['start'], leg['close'])
+            #fill weather_pts and weather_vals
+            for dist, future in zip(dists, leg_futures):
+                timestamps, wind_solars = future.result()
                 roaddir = leg['heading'](dist).item()
 
                 for i in range(len(timestamps)):
@@ -192,6 +299,110 @@ class Route():
         
             print(f"Finished adding weather data to leg {leg['name']}")
 
+    def gen_clearsky(self, dist_step=2000, time_step=600):
+        '''
+        Precompute sun_flat and sun_tilt of every leg on a (distance, time) grid spaced dist_step meters and
+        time_step seconds apart, from the morning of the leg's start day to the evening after it closes.
+        Forecast values are used where they exist, and the clear sky model fills in wherever the forecast
+        is missing (NaN). The original forecast interpolants are kept as sun_flat_forecast and sun_tilt_forecast.
+        Legs without any weather also get zero headwind.
+        '''
+        import forecast.clearsky
+
+        for leg in self.leg_list:
+            dists = np.linspace(0, leg['length'], int(np.ceil(leg['length'] / dist_step)) + 1)
+            first = datetime(leg['start'].year, leg['start'].month, leg['start'].day, CHARGE_START_HOUR)
+            last = datetime(leg['close'].year, leg['close'].month, leg['close'].day, CHARGE_STOP_HOUR) + timedelta(days=1)
+            times = np.arange(first.timestamp(), last.timestamp() + time_step, time_step)
+
+            latitudes = leg['latitude'](dists)[:, None]
+            longitudes = leg['longitude'](dists)[:, None]
+            clearsky = dict(zip(['sun_flat', 'sun_tilt'], forecast.clearsky.get_sun(latitudes, longitudes, times[None, :])))
+
+            Dists, Times = np.meshgrid(dists, times, indexing='ij')
+            for key in ['sun_flat', 'sun_tilt']:
+                if(key + '_forecast' not in leg and key in leg):
+                    leg[key + '_forecast'] = leg[key]
+
+                if(key + '_forecast' in leg):
+                    sun = leg[key + '_forecast'](Dists, Times)
+                    missing = np.isnan(sun)
+                    sun[missing] = clearsky[key][missing]
+                else:
+                    sun = clearsky[key]
+                leg[key] = GridInterp(dists[0], dists[1] - dists[0], times[0], time_step, sun.astype(np.float32))
+
+            if('headwind' not in leg):
+                leg['headwind'] = GridInterp(0, leg['length'], times[0], times[-1] - times[0], np.zeros((2, 2)))
+
+            print(f"Added sun tables to leg {leg['name']}")
+
+    def gen_scenarios(self, k=100, dist_step=5000, time_step=None, sun_sigma=0.3, wind_sigma=2.0, correlation_dist=50000, correlation_time=3*3600, seed=None):
+        '''
+        Add k weather scenarios to every leg by randomly perturbing its forecast, on a (distance, time) grid spaced
+        dist_step meters and time_step seconds apart (default: same as the sun tables). Cloudiness is a lognormal multiplier on the irradiance
+        (never above clear sky), and headwind gets gaussian noise in m/s. Both are correlated over
+        correlation_dist meters and correlation_time seconds. See set_scenarios.
+        '''
+        import forecast.clearsky
+        from scipy.signal import lfilter
+
+        rng = np.random.default_rng(seed)
+
+        def correlated_noise(shape, steps):
+            '''unit variance gaussian noise with an AR(1) correlation of steps samples along each of the first 2 axes'''
+            noise = rng.standard_normal(shape)
+            for axis, n in enumerate(steps):
+                rho = np.exp(-1. / n)
+                #start at stationarity: the first sample passes through with its full variance instead of 1-rho^2 of it
+                first = [slice(None)] * noise.ndim
+                first[axis] = 0
+                noise[tuple(first)] /= np.sqrt(1 - rho**2)
+                noise = lfilter([np.sqrt(1 - rho**2)], [1, -rho], noise, axis=axis)
+            return noise
+
+        if not all(isinstance(leg.get('sun_flat'), GridInterp) for leg in self.leg_list):
+            self.gen_clearsky()
+
+        for leg in self.leg_list:
+            sun_grid = leg['sun_flat']
+            leg_time_step = time_step or sun_grid.dy
+            dists = np.linspace(0, leg['length'], int(np.ceil(leg['length'] / dist_step)) + 1)
+            times = np.arange(sun_grid.y0, sun_grid.y0 + sun_grid.dy * (sun_grid.values.shape[1] - 1) + leg_time_step, leg_time_step)
+            Dists, Times = np.meshgrid(dists, times, indexing='ij')
+            shape = (len(dists), len(times), k)
+            steps = (correlation_dist / (dists[1] - dists[0]), correlation_time / leg_time_step)
+
+            clear_flat, clear_tilt = forecast.clearsky.get_sun(leg['latitude'](dists)[:, None], leg['longitude'](dists)[:, None], times[None, :])
+            sun_flat = leg['sun_flat'](Dists, Times)
+            sun_tilt = leg['sun_tilt'](Dists, Times)
+            cloud = np.exp(sun_sigma * correlated_noise(shape, steps) - sun_sigma**2 / 2)
+
+            headwind = np.nan_to_num(leg['headwind'](Dists, Times))
+            wind = wind_sigma * correlated_noise(shape, steps)
+
+            self.set_scenarios(leg, dists, times, {
+                'sun_flat': np.minimum(sun_flat[:, :, None] * cloud, np.maximum(clear_flat, sun_flat)[:, :, None]),
+                'sun_tilt': np.minimum(sun_tilt[:, :, None] * cloud, np.maximum(clear_tilt, sun_tilt)[:, :, None]),
+                'headwind': headwind[:, :, None] + wind,
+            })
+
+        print(f"Added {k} weather scenarios to {len(self.leg_list)} legs")
+
+    def set_scenarios(self, leg, dists, times, scenarios:dict):
+        '''
+        Store stacked weather scenarios (eg. perturbed forecasts or provider ensemble members) in a leg.
+        dists (m) and times (unix) are evenly spaced grid axes, and scenarios maps 'sun_flat', 'sun_tilt' and
+        'headwind' to arrays of shape (len(dists), len(times), k). leg can be a leg dict or index.
+        They are stored in leg['scenarios'] as GridInterp tables: leg['scenarios']['sun_flat'](d, t) has a trailing axis of length k.
+        '''
+        if not isinstance(leg, dict):
+            leg = self.leg_list[leg]
+        dx = dists[1] - dists[0]
+        dt = times[1] - times[0]
+        leg['scenarios'] = {key: GridInterp(dists[0], dx, times[0], dt, np.asarray(scenarios[key], dtype=np.float32))
+                            for key in ['sun_flat', 'sun_tilt', 'headwind']}
+
     def save_as(self, name):
         with open(dir + '/route/saved_routes/' + name + '.route', "wb") as f:
             pickle.dump(self, f)
@@ -203,47 +414,13 @@ class Route():
 
 def main():
 
-    # Generate route: 
-    route = Route()
-    route.add_leg(
-        type =      'base',
-        end =       'checkpoint',
-        gps_csv =   dir + '/route/asc2022/gps/stage1_ckpt1.csv', 
-        steps_csv = dir + '/route/asc2022/steps/steps_stage1_ckpt1.csv',
-        start =     datetime(2022, 7, 9, 9, 00),
-        open =      datetime(2022, 7, 9, 11, 15),
-        close =     datetime(2022, 7, 9, 13, 45),
-    )
-    route.add_leg(
-        type =      'loop',
-        end =       'checkpoint',
-        gps_csv =   dir + '/route/asc2022/gps/stage1_ckpt1_loop.csv', 
-        steps_csv = dir + '/route/asc2022/steps/steps_stage1_ckpt1_loop.csv',
-        start =     datetime(2022, 7, 9, 12, 00),   #add 45min to ckpt open for hold time
-        open =      datetime(2022, 7, 9, 11, 15),
-        close =     datetime(2022, 7, 9, 14, 00),
-    )
-    route.add_leg(
-        type =      'base',
-        end =       'stagestop',
-        gps_csv =   dir + '/route/asc2022/gps/stage1_ckpt2.csv', 
-        steps_csv = dir + '/route/asc2022/steps/steps_stage1_ckpt2.csv',
-        start =     datetime(2022, 7, 9, 13, 45),   #ckpt1 earliest release time
-        open =      datetime(2022, 7, 10, 9, 00),
-        close =     datetime(2022, 7, 10, 18, 00),
-    )
-    route.add_leg(
-        type =      'loop',
-        end =       'stagestop',
-        gps_csv =   dir + '/route/asc2022/gps/stage1_ckpt2_loop.csv', 
-        steps_csv = dir + '/route/asc2022/steps/steps_stage1_ckpt2_loop.csv', 
-        start =     datetime(2022, 7, 10, 9, 45),   #add 45min to stage open for hold time
-        open =      datetime(2022, 7, 10, 9, 00),
-        close =     datetime(2022, 7, 10, 18, 00),
-    )
+    # Generate route for the full race from the manifest: 
+    route = Route.from_manifest(dir + '/route/asc2022/manifest.json')
+    print(f"Full route length: {round(meters2miles(route.total_length))} miles")
+
     ## UNCOMMENT BELOW TO GENERATE ROUTE FILE
     # route.gen_weather(dist_step=5000)
-    # route.save_as("ind-gra_2022,7,9-10_5km_openmeteo")
+    # route.save_as("ind-twf_2022,7,9-16_5km_openmeteo")
 
 
     new_route = Route.open("ind-gra_2022,7,9-10_5km_openmeteo")
@@ -0,0 +1,113 @@
+import numpy as np
+from scipy.spatial import cKDTree
+import os, sys
+
+sys.path.insert(0, os.path.dirname(__file__)+'/..')   #allow imports from parent directory "onboarding22"
+
+from util import EARTH_RADIUS
+
+TREE_STEP = 100.    #meters between points put in the KD-tree along long segments
+NEIGHBORS = 8       #closest tree points whose segments are checked by a query
+
+def latlong_to_xyz(latitude, longitude):
+    '''Convert arrays of lat/long (degrees) to earth-centered cartesian coordinates (meters) on a spherical earth'''
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat*np.cos(lon), cos_lat*np.sin(lon), np.sin(lat)], axis=-1) * EARTH_RADIUS
+
+
+class RouteIndex():
+    '''
+    KD-tree over the GPS points of one or more legs, used to find where on the route a lat/long is. Segments between points
+    can be over a kilometer long, so the tree also has points every TREE_STEP meters along them, each knowing its segment.
+    Legs are dicts with 'name', 'latitude' and 'longitude' interp1d objects, like the ones made by
+    Route.add_leg or get_geography. Query with RouteIndex.query.
+    '''
+
+    def __init__(self, legs:list):
+        self.names = [leg['name'] for leg in legs]
+
+        points = []
+        leg_ids = []
+        dists = []
+        prev_idx = []
+        next_idx = []
+        n = 0
+        for i, leg in enumerate(legs):
+            leg_dists = leg['latitude'].x   #distances (m) that the route points were given at
+            leg_len = len(leg_dists)
+            points.append(latlong_to_xyz(leg['latitude'].y, leg['longitude'].y))
+            leg_ids.append(np.full(leg_len, i))
+            dists.append(leg_dists)
+
+            #neighboring point on the same leg, or itself at the ends of the leg
+            idx = np.arange(n, n + leg_len)
+            prev_idx.append(np.maximum(idx - 1, n))
+            next_idx.append(np.minimum(idx + 1, n + leg_len - 1))
+            n += leg_len
+
+        self.points = np.concatenate(points)
+        self.leg_ids = np.concatenate(leg_ids)
+        self.dists = np.concatenate(dists)
+        self.prev = np.concatenate(prev_idx)
+        self.next = np.concatenate(next_idx)
+
+        #segment from each point to the next one on its leg
+        self.seg = self.points[self.next] - self.points
+        seg_len2 = np.einsum('ij,ij->i', self.seg, self.seg)
+        self.seg_inv_len2 = np.divide(1, seg_len2, out=np.zeros_like(seg_len2), where=seg_len2 > 0)
+        self.seg_normal = np.cross(self.seg, self.points)  #points right of the direction of travel
+
+        #tree points: every route point, plus evenly spaced points inside segments longer than TREE_STEP
+        seg_dists = self.dists[self.next] - self.dists
+        extra = np.maximum(np.ceil(seg_dists / TREE_STEP).astype(int) - 1, 0)
+        seg_of_extra = np.repeat(np.arange(n), extra)
+        first_extra = np.cumsum(extra) - extra
+        fractions = (np.arange(len(seg_of_extra)) - first_extra[seg_of_extra] + 1) / (extra[seg_of_extra] + 1)
+        extra_points = self.points[seg_of_extra] + fractions[:, None]*self.seg[seg_of_extra]
+        self.tree_seg = np.concatenate([np.arange(n), seg_of_extra])     #segment (by its first point) of each tree point
+        self.tree_is_point = np.concatenate([np.ones(n, dtype=bool), np.zeros(len(seg_of_extra), dtype=bool)])
+        self.tree = cKDTree(np.concatenate([self.points, extra_points]))
+
+    def _project(self, p, start):
+        '''project points p onto the segments beginning at point indices start.
+        Returns the fraction along each segment and the signed distance (+ is right of travel)'''
+        pa = p - self.points[start]
+        seg = self.seg[start]
+        t = np.clip(np.einsum('ij,ij->i', pa, seg) * self.seg_inv_len2[start], 0, 1)
+        offset = pa - t[:, None]*seg
+        err = np.sqrt(np.einsum('ij,ij->i', offset, offset))
+        right = np.einsum('ij,ij->i', pa, self.seg_normal[start]) > 0
+        return t, np.where(right, err, -err)
+
+    def query(self, latitude, longitude, workers=-1):
+        '''
+        Find the closest route segment to each lat/long. Inputs are scalars or arrays of any shape.
+        Returns arrays (leg index, distance along leg in meters, cross-track error in meters).
+        Cross-track error is positive when the point is to the right of the direction of travel.
+        '''
+        latitude = np.asarray(latitude, dtype=float)
+        shape = latitude.shape
+        p = latlong_to_xyz(latitude.ravel(), np.asarray(longitude, dtype=float).ravel())
+
+        k = min(NEIGHBORS, self.tree.n)
+        _, nearest = self.tree.query(p, k=k, workers=workers)
+        nearest = nearest.reshape(len(p), k)
+
+        #candidates are the segments of the closest tree points, and the segments ending at the closest route points
+        seg = self.tree_seg[nearest]
+        candidates = np.concatenate([seg, np.where(self.tree_is_point[nearest], self.prev[seg], seg)], axis=1)
+        t, err = self._project(np.repeat(p, 2*k, axis=0), candidates.ravel())
+        t, err = t.reshape(candidates.shape), err.reshape(candidates.shape)
+
+        best = np.argmin(np.abs(err), axis=1)
+        rows = np.arange(len(p))
+        start = candidates[rows, best]
+        stop = self.next[start]
+        t = t[rows, best]
+
+        legs = self.leg_ids[start]
+        dists = self.dists[start] + t*(self.dists[stop] - self.dists[start])
+        errs = err[rows, best]
+        return legs.reshape(shape), dists.reshape(shape), errs.reshape(shape)
@@ -0,0 +1,109 @@
+'''
+Evaluates a strategy under many weather scenarios at once. The race is simulated once with the forecast, then
+the energy of that same drive is recomputed for every scenario stored in the route (see Route.gen_scenarios)
+in one vectorized batch. This is open loop: the car drives the same speeds in every scenario, and a scenario
+only ends early if its battery runs out.
+
+To run: ` python simulator/montecarlo.py `
+'''
+
+import numpy as np
+import sys, os
+
+dir = os.path.dirname(__file__)
+sys.path.insert(0, dir+'/../')   #allow imports from parent directory "onboarding22"
+
+from simulator.raceEnv import RaceEnv, motor_power, TRACE_DRIVE, TRACE_CHARGE, TRACE_EARN
+from route.route import Route   #needed to unpickle saved routes
+
+CHARGE_TIMESTEP = 5     #seconds, same as RaceEnv.charge
+
+
+def evaluate_scenarios(env:RaceEnv):
+    '''
+    Recompute the energy of env's finished run under every weather scenario of its route.
+    Returns a dict of arrays with one value per scenario: 'miles_earned', 'watthours' left,
+    and 'ran_out' (whether the battery ran out).
+    '''
+    trace = np.array(env.trace, dtype=float)
+    kinds = trace[:, 0].astype(int)
+    leg_ids = trace[:, 1].astype(int)
+    dists, times, dts, speeds, accels, dist_changes, alt_changes, miles = trace[:, 2:].T
+    car = env.car_props
+    k = env.legs[0]['scenarios']['sun_flat'].values.shape[2]
+
+    drive = kinds == TRACE_DRIVE
+    charge = kinds == TRACE_CHARGE
+    sinslopes = np.divide(alt_changes, dist_changes, out=np.zeros_like(dist_changes), where=dist_changes > 1)
+
+    #energy gained (J) during each event of the trace, for each scenario
+    deltas = np.zeros((len(trace), k))
+    for leg_index in np.unique(leg_ids[drive | charge]):
+        scenarios = env.legs[leg_index]['scenarios']
+
+        rows = np.flatnonzero(drive & (leg_ids == leg_index))
+        if len(rows) > 0:
+            headwinds = scenarios['headwind'](dists[rows], times[rows])
+            array_powers = scenarios['sun_flat'](dists[rows], times[rows]) * car['array_multiplier']
+            motor_powers = motor_power(car, accels[rows, None], speeds[rows, None], headwinds, sinslopes[rows, None])
+            deltas[rows] = (array_powers - motor_powers) * dts[rows, None]
+
+        rows = np.flatnonzero(charge & (leg_ids == leg_index))
+        if len(rows) > 0:
+            #sample every CHARGE_TIMESTEP seconds of each charge like RaceEnv.charge, then sum each charge
+            counts = np.ceil(np.round((dts[rows] + CHARGE_TIMESTEP) / CHARGE_TIMESTEP, 6)).astype(int)
+            firsts = np.cumsum(counts) - counts
+            offsets = np.arange(counts.sum()) - np.repeat(firsts, counts)
+            sample_times = np.repeat(times[rows], counts) + offsets * CHARGE_TIMESTEP
+            sample_dists = np.repeat(dists[rows], counts)
+            irradiances = scenarios['sun_tilt'](sample_dists, sample_times)
+            deltas[rows] = np.add.reduceat(irradiances, firsts, axis=0) * car['array_multiplier'] * CHARGE_TIMESTEP
+
+    #battery can't charge past full: energy = unclamped energy - the most it has ever been over capacity
+    max_energy = car['max_watthours'] * 3600
+    unclamped = max_energy + np.cumsum(deltas, axis=0)
+    energies = unclamped - np.maximum(np.maximum.accumulate(unclamped - max_energy, axis=0), 0)
+
+    #each scenario ends at the first drive step with an empty battery
+    empty = (energies <= 0) & drive[:, None]
+    ran_out = empty.any(axis=0)
+    last = np.where(ran_out, empty.argmax(axis=0), len(trace) - 1)
+
+    miles_earned = np.cumsum(np.where(kinds == TRACE_EARN, miles, 0))
+
+    return {
+        'miles_earned': miles_earned[last],
+        'watthours': energies[last, np.arange(k)] / 3600.,
+        'ran_out': ran_out,
+    }
+
+
+def run_scenarios(control, scenarios=100, **env_kwargs):
+    '''
+    Simulate the race once and evaluate it under every weather scenario. control is a function that is
+    called with the RaceEnv before every step, where it can call setters like the while loop in sim.py.
+    If the route doesn't have weather scenarios, this many are generated.
+    '''
+    env = RaceEnv(load=None, save=False, do_render=False, do_print=False, scenarios=scenarios, stop_on_empty=False, **env_kwargs)
+    done = False
+    while not done:
+        control(env)
+        done = env.step()
+    return evaluate_scenarios(env)
+
+
+def main():
+    def control(env):
+        env.set_target_mph(30)
+        env.set_try_loop(True)
+
+    results = run_scenarios(control, scenarios=100)
+
+    for key in ['miles_earned', 'watthours']:
+        percentiles = np.percentile(results[key], [5, 50, 95])
+        print(f"{key}: mean {np.mean(results[key]):.1f}, 5/50/95th percentile {np.round(percentiles, 1)}")
+    print(f"Battery ran out in {np.mean(results['ran_out'])*100:.0f}% of scenarios")
+
+
+if __name__ == "__main__":
+    main()
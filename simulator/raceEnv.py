@@ -18,6 +18,27 @@ from route.route import *
 from util import *
 
 
+#kinds of events in RaceEnv.trace
+TRACE_DRIVE = 0     #driving for dt seconds
+TRACE_CHARGE = 1    #charging in place for dt seconds
+TRACE_EARN = 2      #change in miles earned
+
+WEATHER_POINTS = 100    #points along a leg that solar and wind are drawn at
+SPEED_TRACE_SIZE = 4096 #starting size of the buffer of the speed trace that is drawn
+
+def motor_power(car_props, accel, speed, headwind, sinslope):
+    '''
+    Motor power loss in W, positive meaning power is used. Works on scalars or numpy arrays, which broadcast.
+    '''
+    P_drag = car_props['P_drag']
+    P_fric = car_props['P_fric']
+    P_accel = car_props['P_accel']
+    mg = car_props['mass'] * 9.81
+
+    power_ff = speed * (P_drag*(speed + headwind)**2 + P_fric + mg*sinslope)      #power used to keep the avg speed
+    power_acc = P_accel*accel*speed                                             #power used to accelerate (or decelerate)
+    return power_ff + power_acc
+
 
 class RaceEnv(gym.Env):
     '''Simulation of ASC using an OpenAI gym environment. Call .step(action) to update simulation.
@@ -31,19 +52,27 @@ class RaceEnv(gym.Env):
         do_print: boolean of whether to print progress reports along the race
         car: name of the car to simulate. Cars are stored as .json in the cars/ folder.
         route: name of the route to simulate. Routes are stored as .route in the route/save_routes folder.
+        scenarios: number of weather scenarios to generate if the route doesn't have them. See simulator/montecarlo.py.
+        stop_on_empty: boolean of whether to end the simulation when the battery runs out.
 
         Note: do not use file extensions (eg .csv) when specifying file names. They will be added automatically.
     '''
 
-    def __init__(self, load=None, save=True, save_name='', do_render=True, do_print=True, car="brizo_fsgp22", route="ind-gra_2022,7,9-10_5km_openmeteo"):
+    def __init__(self, load=None, save=True, save_name='', do_render=True, do_print=True, car="brizo_fsgp22", route="ind-gra_2022,7,9-10_5km_openmeteo", scenarios=0, stop_on_empty=True):
 
         cars_dir = os.path.dirname(__file__) + '/../cars'
         with open(f"{cars_dir}/{car}.json", 'r') as props_json:
             self.car_props = json.load(props_json)
         
         route_obj = Route.open(route)
+        if not all(isinstance(leg.get('sun_flat'), GridInterp) for leg in route_obj.leg_list):
+            route_obj.gen_clearsky()    #fill gaps in the forecast with clear sky irradiance, for routes saved without sun tables
+        if scenarios > 0 and not all('scenarios' in leg for leg in route_obj.leg_list):
+            route_obj.gen_scenarios(k=scenarios)
         self.legs = route_obj.leg_list
 
+        self.stop_on_empty = stop_on_empty
+
         self.save = save
         self.save_name = save_name
 
@@ -116,6 +145,7 @@ class RaceEnv(gym.Env):
         self.pause = False
         self.steps_per_render = 1
 
+        self.leg_data = {}      #cached arrays of each leg, see get_leg_data
         self.reset()
         if(self.do_render):
             self.render_init()
@@ -131,15 +161,16 @@ class RaceEnv(gym.Env):
     def reset_leg(self):
         self.leg_progress = 0
         self.speed = 0
-        self.next_stop_dist = 0
+        stop_dists = self.current_leg['stop_dists']
+        self.next_stop_dist = stop_dists[0] if len(stop_dists) > 0 else float('inf')    #legs without steps have no stops
         self.next_stop_index = 0
         self.limit = None
         self.next_limit_dist = 0
         self.next_limit_index = 0
         self.distwindow_l = 0
         self.distwindow_r = miles2meters(self.dist_behind + self.dist_ahead)
-        limit_dist_pts, limit_pts = self.current_leg['speedlimit']
-        self.limit_dist_pts, self.limit_pts = ffill(limit_dist_pts, limit_pts)
+        data = self.get_leg_data()
+        self.limit_dist_pts, self.limit_pts = data['limit_dist_pts'], data['limit_pts']
 
         self.log['leg_names'].append(self.current_leg['name'])
         for item in self.log:
@@ -175,6 +206,9 @@ class RaceEnv(gym.Env):
             "array_powers": [],
         }
 
+        #every drive step, charge, and change in miles earned, in order: (kind, leg index, dist, time, dt, speed, accel, dist change, alt change, miles)
+        self.trace = []
+
         self.reset_leg()
 
 
@@ -190,11 +224,11 @@ class RaceEnv(gym.Env):
 
         timestep = 5
         times = np.arange(self.time.timestamp(), end_time.timestamp()+timestep, step=timestep)
-        irradiances = np.array([leg['sun_tilt'](self.leg_progress, time) for time in times])
-        irradiances = np.nan_to_num(irradiances)
+        irradiances = np.nan_to_num(leg['sun_tilt'](self.leg_progress, times))
         powers = irradiances * self.car_props['array_multiplier']
 
         before = self.energy
+        self.trace.append((TRACE_CHARGE, self.leg_index, self.leg_progress, self.time.timestamp(), time_length.total_seconds(), 0, 0, 0, 0, 0))
 
         self.energy += powers.sum() * timestep
         self.energy = min(self.energy, self.car_props['max_watthours']*3600)
@@ -217,6 +251,7 @@ class RaceEnv(gym.Env):
         else:
             self.printc(f"Earned {round(meters2miles(leg['length']))} miles")
             self.miles_earned += meters2miles(leg['length']) #earn miles if completed on time
+            self.trace.append((TRACE_EARN, self.leg_index, leg['length'], self.time.timestamp(), 0, 0, 0, 0, 0, meters2miles(leg['length'])))
             self.legs_completed += 1
             self.legs_completed_names.append(leg['name'])
 
@@ -339,6 +374,7 @@ class RaceEnv(gym.Env):
                 if(leg['type']=='base'):
                     self.printc('Did not make stagestop on time, considered trailered')        
                     self.done = True
+                    self.trace.append((TRACE_EARN, self.leg_index, self.leg_progress, self.time.timestamp(), 0, 0, 0, 0, 0, -self.miles_earned))
                     self.miles_earned = 0
                     return
                 else:
@@ -379,20 +415,12 @@ class RaceEnv(gym.Env):
         '''
         Motor power loss in W, positive meaning power is used
         '''
-        P_drag = self.car_props['P_drag']
-        P_fric = self.car_props['P_fric']
-        P_accel = self.car_props['P_accel']
-        mg = self.car_props['mass'] * 9.81
-
         if(dist_change > 1): #protect against zero division
             sinslope = (alt_change / dist_change)
         else:
             sinslope = 0
 
-        #can probably be made into a matrix
-        power_ff = speed * (P_drag*(speed + headwind)**2 + P_fric + mg*sinslope)      #power used to keep the avg speed
-        power_acc = P_accel*accel*speed                                                                 #power used to accelerate (or decelerate)
-        return power_ff + power_acc
+        return motor_power(self.car_props, accel, speed, headwind, sinslope)
 
 
     def step(self, action=None):
@@ -490,6 +518,7 @@ class RaceEnv(gym.Env):
 
                 self.motor_power = self.get_motor_power(a, v_avg, w, stopping_dist, alt_change)
                 self.energy -= self.motor_power * stopping_time
+                self.trace.append((TRACE_DRIVE, self.leg_index, d_0, self.time.timestamp(), stopping_time, v_avg, a, stopping_dist, alt_change, 0))
 
                 self.array_power = leg['sun_flat'](d_0, self.time.timestamp()) * self.car_props['array_multiplier']
                 if(not isnan(self.array_power)):
@@ -550,6 +579,7 @@ class RaceEnv(gym.Env):
 
         self.motor_power = self.get_motor_power(a, v_avg, w, d_f-d_0, alt_change)
         self.energy -= self.motor_power * dt
+        self.trace.append((TRACE_DRIVE, self.leg_index, d_0, self.time.timestamp(), dt, v_avg, a, d_f-d_0, alt_change, 0))
 
         self.array_power = leg['sun_flat'](d_0, self.time.timestamp()) * self.car_props['array_multiplier']
         if(not isnan(self.array_power)):
@@ -559,7 +589,7 @@ class RaceEnv(gym.Env):
             
         self.time += timedelta(seconds=dt)
 
-        if(self.energy <= 0):
+        if(self.energy <= 0 and self.stop_on_empty):
             self.printc("No battery, ending simulation")
             self.end_race()
             return True
@@ -578,7 +608,7 @@ class RaceEnv(gym.Env):
             self.reset_leg()
 
             if(self.do_render):
-                self.render_init()
+                self.render_leg()
 
         # CHECK IF END OF DAY
         if(self.time > datetime(self.time.year, self.time.month, self.time.day, DRIVE_STOP_HOUR)):
@@ -621,54 +651,60 @@ class RaceEnv(gym.Env):
 
 
 
+    def get_leg_data(self, index=None):
+        '''
+        Arrays of a leg (by default the current one) used by reset_leg and rendering, made the first time the leg is started and
+        reused after, since loops are driven again and again: the forward filled speed limit steps, the elevation profile and the
+        distances that weather is drawn at.
+        '''
+        index = self.leg_index if index is None else index
+        if index not in self.leg_data:
+            leg = self.legs[index]
+            limit_dist_pts, limit_pts = ffill(*leg['speedlimit'])
+            profile_dists = np.arange(0, leg['length'], step=30)
+            elevs = leg['altitude'](profile_dists)
+            self.leg_data[index] = {
+                'limit_dist_pts': limit_dist_pts,
+                'limit_pts': limit_pts,
+                'profile_dists': profile_dists,
+                'elevs': elevs,
+                'min_elev': elevs.min(),
+                'max_elev': elevs.max(),
+                'weather_dists': np.linspace(0, leg['length'], WEATHER_POINTS, endpoint=False),
+            }
+        return self.leg_data[index]
+
     def render_init(self):
+        '''Make the figure and its artists, once. render_leg swaps in the data of each leg'''
         self.transition = True
         plt.close('all')
         self.transition = False
 
-        leg = self.current_leg
-
         import tkinter as tk
         root = tk.Tk()
         screen_width = root.winfo_screenwidth()
         screen_height = root.winfo_screenheight()
+        root.destroy()
 
         self.fig = plt.figure(figsize=(15, 13 * screen_height/screen_width))
 
-        ax_elev = plt.subplot2grid((3, 8), (0, 0), colspan=8)
-        ax_speed = plt.subplot2grid((3, 8), (1, 0), colspan=7, rowspan=2)
+        self.ax_elev = ax_elev = plt.subplot2grid((3, 8), (0, 0), colspan=8)
+        self.ax_speed = ax_speed = plt.subplot2grid((3, 8), (1, 0), colspan=7, rowspan=2)
         ax_power = plt.subplot2grid((3, 8), (1, 7), rowspan=1)
         ax_battery = plt.subplot2grid((3, 8), (2, 7), rowspan=1)
 
-        #in meters
-        self.distwindow_l = 0
-        self.distwindow_r = miles2meters(self.dist_behind + self.dist_ahead)
-
         #elevation axes
         ax_elev.set_ylabel("Elevation (meters)")
-        dists_leg = np.arange(0, leg['length'], step=30)
-        elevs = self.current_leg['altitude'](dists_leg)
-        self.min_elev = min(elevs)
-        self.max_elev = max(elevs)
-        ax_speed.set_ylim(0, self.max_elev*1.05)
-        (self.ln_elev) = ax_elev.plot(dists_leg * meters2miles(), elevs, '-', label="elevation")
-        (self.ln_distwindow_l,) = ax_elev.plot((meters2miles(self.distwindow_l), meters2miles(self.distwindow_l)), (self.min_elev, self.max_elev), 'y-')
-        (self.ln_distwindow_r,) = ax_elev.plot((meters2miles(self.distwindow_r), meters2miles(self.distwindow_r)), (self.min_elev, self.max_elev), 'y-')
-        (self.pt_elev,) = ax_elev.plot(0, leg['altitude'](0), 'ko', markersize=5)
-
-        weather_step = round(leg['length'] / 100)
-        self.weather_dists = np.arange(0, leg['length'], step=weather_step)
-        n_dists = len(self.weather_dists)
-
-        solars = leg['sun_flat'](self.weather_dists, self.time.timestamp())
-        colors = interp_color(vals=solars, min_val=min(solars), max_val=max(solars), min_color=SUN_RED, max_color=SUN_YELLOW)
-        self.pts_solar = ax_elev.scatter(self.weather_dists * meters2miles(), np.ones_like(self.weather_dists)*(self.min_elev + 1.05*(self.max_elev - self.min_elev)), c=colors, s=solars/10)
-        ax_elev.text(-0.5, (self.min_elev + 1.05*(self.max_elev - self.min_elev)), "solar", ha='right', va='center')
-
-        winds = self.current_leg['headwind'](self.weather_dists, self.time.timestamp())
-        self.pts_wind = ax_elev.quiver(self.weather_dists * meters2miles(), np.ones_like(self.weather_dists)*(self.min_elev + 1*(self.max_elev - self.min_elev)), -winds, np.zeros(n_dists), headwidth=2, minlength=0, scale=200, scale_units='width')
-        ax_elev.text(-0.5, (self.min_elev + 1.0*(self.max_elev - self.min_elev)), "wind", ha='right', va='center')
+        (self.ln_elev,) = ax_elev.plot([], [], '-', label="elevation")
+        (self.ln_distwindow_l,) = ax_elev.plot([], [], 'y-')
+        (self.ln_distwindow_r,) = ax_elev.plot([], [], 'y-')
+        (self.pt_elev,) = ax_elev.plot([], [], 'ko', markersize=5)
 
+        zeros = np.zeros(WEATHER_POINTS)
+        self.pts_solar = ax_elev.scatter(zeros, zeros)
+        self.tx_solar = ax_elev.text(-0.5, 0, "solar", ha='right', va='center')
+        self.pts_wind = ax_elev.quiver(zeros, zeros, zeros, zeros, headwidth=2, minlength=0, scale=200, scale_units='width')
+        self.tx_wind = ax_elev.text(-0.5, 0, "wind", ha='right', va='center')
 
         ax_elev.legend(loc='lower left')
 
@@ -676,14 +712,10 @@ class RaceEnv(gym.Env):
         #speed axes
         ax_speed.set_ylabel("Speed (mph)")
         ax_speed.set_xlabel("Distance (miles)")
-        ax_speed.set_xlim(0, meters2miles(self.distwindow_r))
+        ax_speed.set_xlim(0, self.dist_behind + self.dist_ahead)
         ax_speed.set_ylim(0, self.car_props['max_mph']*1.1)
 
-        limit_dist_pts, limit_pts = self.current_leg['speedlimit']
-
-        limit_dist_pts, limit_pts = trim_to_range(self.limit_dist_pts, self.limit_pts, self.distwindow_l, self.distwindow_r)
-
-        (self.ln_limit,) = ax_speed.plot(limit_dist_pts*meters2miles(), limit_pts*mpersec2mph(), label='Speed limit', c='gray')
+        (self.ln_limit,) = ax_speed.plot([], [], label='Speed limit', c='gray')
         (self.ln_speed,) = ax_speed.plot(0, 0, label='Car speed', c='black')
         (self.pt_speed,) = ax_speed.plot(0, 0, 'ko', markersize=5)
 
@@ -691,9 +723,8 @@ class RaceEnv(gym.Env):
 
         self.power_hist = 100
         self.battery_hist = 1000
-        self.motor_powers_disp = np.full(self.power_hist*2, 0)
-        self.array_powers_disp = np.full(self.power_hist, 0)
-        self.battery_disp = np.full(self.battery_hist, self.energy/3600)
+        self.power_times = np.linspace(0, 3600, self.power_hist)
+        self.battery_times = np.linspace(0, 3600, self.battery_hist)
 
         #power axes
         ax_power.set_title("Array power (W)")
@@ -713,14 +744,13 @@ class RaceEnv(gym.Env):
         (self.ln_battery,) = ax_battery.plot([0,3600], [self.energy/3600.,self.energy/3600.], label='Battery energy', c='green')
 
         #Text
-        leg = self.current_leg
-        closetime = leg['close'].strftime('%m/%d/%Y, %H:%M')
-        ax_speed.set_title(f"{leg['name']}. Close time: {closetime}")
-        self.tx_time = ax_speed.text(5, self.car_props['max_mph']*1.05, f"{self.time.strftime('%m/%d/%Y, %H:%M')}", fontsize=15, ha='center', va='top')
+        self.tx_time = ax_speed.text(5, self.car_props['max_mph']*1.05, "", fontsize=15, ha='center', va='top')
         self.tx_input = ax_speed.text(5, 0, "", fontsize=15, ha='center', va='bottom')
 
 
+        self.render_leg(redraw=False)   #lay out the figure with the first leg's data
         plt.tight_layout()
+        self.speed_pixels = max(int(ax_speed.get_window_extent().width), 1)    #the speed trace is downsampled to this many points
 
         self.bm = BlitManager(self.fig, (
             self.pt_elev, self.ln_distwindow_l, self.ln_distwindow_r, self.pts_solar, self.pts_wind,
@@ -729,90 +759,181 @@ class RaceEnv(gym.Env):
             self.ln_battery,
         ))
 
-        #closing the first window deletes the second window
+        #closing the window ends the simulation
         def on_close(event):
             if not self.transition:
                 self.printc("Window closed, ending simulation early.")
                 sys.exit()
         self.fig.canvas.mpl_connect('close_event', on_close)
 
-        def update_tx():
-            if(self.tx_input is not None):
-                if(self.pause):
-                    pause_str = "Press [P] to unpause"
-                else:
-                    pause_str = "Press [P] to pause"
-                
-                speed_str = "[1-9] for simulation speed"
-
-                if(self.load is not None):
-                    action_str = f"Loaded input from file: {self.load_name}"
-                else:
-                    action_str = f"Target [Arrow keys]: {self.action['target_mph']}mph  \n Try loop [Enter]: {self.action['try_loop']}"
-                next_leg_str = f"Upcoming leg: {self.get_next_leg()}"
-                self.tx_input.set_text(f"{pause_str}\n{speed_str}\n{action_str}\n{next_leg_str}")
-
-
         def press(event):
             if(self.load is None):
                 if(event.key == 'up'):
                     self.is_keyboard = True
                     self.action['target_mph'] = min(self.action['target_mph']+2, self.car_props['max_mph'])
-                    update_tx()
+                    self.update_tx()
                 if(event.key == 'down'):
                     self.is_keyboard = True
                     self.action['target_mph'] = max(self.action['target_mph']-2, 5)
-                    update_tx()
+                    self.update_tx()
                 if(event.key == 'enter'):
                     self.is_keyboard = True
                     self.action['try_loop'] = not self.action['try_loop']
                     self.try_loop = self.action['try_loop']
-                    update_tx()
+                    self.update_tx()
             if(event.key == 'p'):
                 self.pause = not self.pause
-                update_tx()
+                self.update_tx()
                 self.bm.update()
             if(event.key.isdigit()):
                 num = int(event.key)
                 if(num >= 1 and num <= 9):
                     self.steps_per_render = num
 
-            
-        self.pause = True
-
         self.fig.canvas.mpl_connect('key_press_event', press)
-        update_tx()
 
         plt.pause(.01) #wait a bit for things to be drawn and cached
         self.bm.update()
 
+    def render_leg(self, redraw=True):
+        '''Swap the data of the figure's artists for the current leg, from get_leg_data, and pause until the user unpauses'''
+        leg = self.current_leg
+        data = self.get_leg_data()
+
+        #in meters
+        self.distwindow_l = 0
+        self.distwindow_r = miles2meters(self.dist_behind + self.dist_ahead)
+
+        #elevation axes
+        min_elev = data['min_elev']
+        max_elev = max(data['max_elev'], min_elev + 1)      #flat legs still get some height
+        solar_y = min_elev + 1.05*(max_elev - min_elev)
+        wind_y = min_elev + 1.0*(max_elev - min_elev)
+        self.ln_elev.set_data(data['profile_dists'] * meters2miles(), data['elevs'])
+        self.ln_distwindow_l.set_data((meters2miles(self.distwindow_l), meters2miles(self.distwindow_l)), (min_elev, max_elev))
+        self.ln_distwindow_r.set_data((meters2miles(self.distwindow_r), meters2miles(self.distwindow_r)), (min_elev, max_elev))
+        self.pt_elev.set_data([0], [leg['altitude'](0)])
+
+        weather_miles = data['weather_dists'] * meters2miles()
+        self.pts_solar.set_offsets(np.column_stack([weather_miles, np.full(WEATHER_POINTS, solar_y)]))
+        self.pts_wind.set_offsets(np.column_stack([weather_miles, np.full(WEATHER_POINTS, wind_y)]))
+        self.tx_solar.set_y(solar_y)
+        self.tx_wind.set_y(wind_y)
+        self.update_weather()
+
+        #same limits autoscaling gave when the figure was made for each leg
+        x_max = max(meters2miles(leg['length']), meters2miles(self.distwindow_r))
+        self.ax_elev.set_xlim(-0.05*x_max, 1.05*x_max)
+        y_pad = 0.05*(solar_y - min_elev)
+        self.ax_elev.set_ylim(min_elev - y_pad, solar_y + y_pad)
+
+        #speed axes
+        limit_dist_pts, limit_pts = trim_to_range(self.limit_dist_pts, self.limit_pts, self.distwindow_l, self.distwindow_r)
+        self.ln_limit.set_data(limit_dist_pts*meters2miles(), limit_pts*mpersec2mph())
+        self.ln_speed.set_data([0], [0])
+        self.pt_speed.set_data([0], [0])
+
+        #speed trace of the leg so far, copied from the log a step at a time. trace_start is the first point in the distance window
+        self.trace_dists = np.empty(SPEED_TRACE_SIZE)
+        self.trace_speeds = np.empty(SPEED_TRACE_SIZE)
+        self.trace_start = 0
+        self.trace_end = 0
+        self.trace_logged = 0       #steps of the leg's log copied so far
+
+        self.motor_powers_disp = RingBuffer(self.power_hist)    #for the moving average of motor power
+        self.motor_avgs_disp = RingBuffer(self.power_hist)
+        self.array_powers_disp = RingBuffer(self.power_hist)
+        self.battery_disp = RingBuffer(self.battery_hist, self.energy/3600)
+        self.ln_arraypower.set_data([0], [0])
+        self.ln_motorpower.set_data([0], [0])
+        self.ln_battery.set_data([0,3600], [self.energy/3600.,self.energy/3600.])
+
+        #Text
+        closetime = leg['close'].strftime('%m/%d/%Y, %H:%M')
+        self.ax_speed.set_title(f"{leg['name']}. Close time: {closetime}")
+        self.tx_time.set_text(f"{self.time.strftime('%m/%d/%Y, %H:%M')}")
+
+        self.pause = True
+        self.update_tx()
+
+        if(redraw):
+            self.fig.canvas.draw()      #redraws the static artists, and the blit manager grabs the new background
+            self.bm.update()
+
+    def update_weather(self):
+        '''Color and size the solar points and point the wind arrows by the forecast at the current time'''
+        weather_dists = self.get_leg_data()['weather_dists']
+        solars = self.current_leg['sun_flat'](weather_dists, self.time.timestamp())
+        colors = interp_color(vals=solars, min_val=min(solars), max_val=max(solars), min_color=SUN_RED, max_color=SUN_YELLOW)
+        self.pts_solar.set_facecolors(colors)
+        self.pts_solar.set_sizes(solars/10)
+
+        winds = self.current_leg['headwind'](weather_dists, self.time.timestamp())
+        self.pts_wind.set_UVC(U=-winds, V=np.zeros_like(winds))
+
+    def update_tx(self):
+        if(self.tx_input is not None):
+            if(self.pause):
+                pause_str = "Press [P] to unpause"
+            else:
+                pause_str = "Press [P] to pause"
+            
+            speed_str = "[1-9] for simulation speed"
+
+            if(self.load is not None):
+                action_str = f"Loaded input from file: {self.load_name}"
+            else:
+                action_str = f"Target [Arrow keys]: {self.action['target_mph']}mph  \n Try loop [Enter]: {self.action['try_loop']}"
+            next_leg_str = f"Upcoming leg: {self.get_next_leg()}"
+            self.tx_input.set_text(f"{pause_str}\n{speed_str}\n{action_str}\n{next_leg_str}")
+
+    def update_speed_trace(self):
+        '''
+        Copy the steps logged since the last frame onto the end of the speed trace, and move its start past points that have left
+        the distance window. Distances only increase within a leg, so each point is copied and passed once, and the buffer is
+        compacted (or grown if the window fills it) instead of rebuilding arrays from the whole leg's log every frame.
+        '''
+        dists = self.log['dists'][-1]
+        if(len(dists) < self.trace_logged):     #the log was reset
+            self.trace_start = self.trace_end = self.trace_logged = 0
+        new = len(dists) - self.trace_logged
+        if(new > 0):
+            if(self.trace_end + new > len(self.trace_dists)):
+                kept = self.trace_end - self.trace_start
+                size = max(len(self.trace_dists), 2*(kept + new))
+                trace_dists, trace_speeds = np.empty(size), np.empty(size)
+                trace_dists[:kept] = self.trace_dists[self.trace_start:self.trace_end]
+                trace_speeds[:kept] = self.trace_speeds[self.trace_start:self.trace_end]
+                self.trace_dists, self.trace_speeds = trace_dists, trace_speeds
+                self.trace_start, self.trace_end = 0, kept
+            self.trace_dists[self.trace_end:self.trace_end + new] = dists[self.trace_logged:]
+            self.trace_speeds[self.trace_end:self.trace_end + new] = self.log['speeds'][-1][self.trace_logged:]
+            self.trace_end += new
+            self.trace_logged += new
+
+        self.trace_start += np.searchsorted(self.trace_dists[self.trace_start:self.trace_end], self.distwindow_l)
+
     def render(self):
         self.pt_elev.set_xdata(meters2miles(self.leg_progress))
         self.pt_elev.set_ydata(self.current_leg['altitude'](self.leg_progress))
 
 
         if(self.sim_step % 50 ==0):
-            solars = self.current_leg['sun_flat'](self.weather_dists, self.time.timestamp())
-            colors = interp_color(vals=solars, min_val=min(solars), max_val=max(solars), min_color=SUN_RED, max_color=SUN_YELLOW)
-            self.pts_solar.set_facecolors(colors)
-            self.pts_solar.set_sizes(solars/10)
-
-            winds = self.current_leg['headwind'](self.weather_dists, self.time.timestamp())
-            self.pts_wind.set_UVC(U=-winds, V=np.zeros_like(winds))
+            self.update_weather()
 
         if(self.leg_progress > miles2meters(self.dist_behind)):
             self.distwindow_l = self.leg_progress - miles2meters(self.dist_behind)
             self.distwindow_r = self.leg_progress + miles2meters(self.dist_ahead)
         
-        dists_so_far = np.array(self.log['dists'][-1])
-        speeds_so_far = np.array(self.log['speeds'][-1])
+        self.update_speed_trace()
+        speeds_dists_window = self.trace_dists[self.trace_start:self.trace_end]
+        speeds_window = self.trace_speeds[self.trace_start:self.trace_end]
 
-        speeds_dists_window, speeds_window = trim_to_range(dists_so_far, speeds_so_far, self.distwindow_l, self.distwindow_r)
-        
         try:
             dist_shift = speeds_dists_window[0]
         except:
             dist_shift = 0
+        speeds_dists_window, speeds_window = minmax_downsample(speeds_dists_window, speeds_window, self.speed_pixels)
 
         self.ln_speed.set_xdata(meters2miles(speeds_dists_window-dist_shift))
         self.ln_speed.set_ydata(mpersec2mph(speeds_window))
@@ -827,28 +948,16 @@ class RaceEnv(gym.Env):
         self.pt_speed.set_xdata(meters2miles(self.leg_progress-dist_shift))
         self.pt_speed.set_ydata(mpersec2mph(self.speed))
 
-        self.motor_powers_disp = np.roll(self.motor_powers_disp, -1)
-        self.motor_powers_disp[-1] = self.motor_power
-        self.array_powers_disp = np.roll(self.array_powers_disp, -1)
-        self.array_powers_disp[-1] = self.array_power
-        self.battery_disp = np.roll(self.battery_disp, -1)
-        self.battery_disp[-1] = self.energy/3600
+        self.motor_powers_disp.push(self.motor_power)
+        self.motor_avgs_disp.push(self.motor_powers_disp.mean())
+        self.array_powers_disp.push(self.array_power)
+        self.battery_disp.push(self.energy/3600)
 
         disp_step = 12
         if(self.sim_step % disp_step == 0):
-
-            power_times = np.linspace(0, 3600, self.power_hist)
-
-            motor_avg = moving_average(self.motor_powers_disp, self.power_hist)[-self.power_hist:]
-            self.ln_motorpower.set_xdata(power_times)
-            self.ln_motorpower.set_ydata(motor_avg)
-
-            self.ln_arraypower.set_xdata(power_times)
-            self.ln_arraypower.set_ydata(self.array_powers_disp)
-
-            battery_times = np.linspace(0, 3600, self.battery_hist)
-            self.ln_battery.set_xdata(battery_times)
-            self.ln_battery.set_ydata(self.battery_disp)
+            self.ln_motorpower.set_data(self.power_times, self.motor_avgs_disp.values())
+            self.ln_arraypower.set_data(self.power_times, self.array_powers_disp.values())
+            self.ln_battery.set_data(self.battery_times, self.battery_disp.values())
 
             self.tx_time.set_text(self.time.strftime('%m/%d/%Y, %H:%M'))
 
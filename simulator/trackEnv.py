@@ -0,0 +1,293 @@
+'''
+Simulation of a track race like FSGP, where the score is the number of laps of a closed circuit completed in each day's
+driving window. The track is built once into tables along one lap (slope, heading, sun over the day) that are indexed by
+distance modulo the lap length, and each lap is simulated in one vectorized batch over the track, so a whole 8 hour day
+takes a few milliseconds and lap speed strategies can be swept.
+
+Rules modelled: the car drives from DRIVE_START_HOUR to DRIVE_STOP_HOUR and only laps finished in that window count.
+Drivers swap in the pits after at most MAX_STINT_HOURS of driving, which takes DRIVER_SWAP_MINUTES. The array charges
+flat while driving or in the pits, and tilted towards the sun from CHARGE_START_HOUR until driving starts and from when driving
+stops until CHARGE_STOP_HOUR. If the battery runs out on track the lap doesn't count, and the car charges in the pits
+until it has RESTART_WATTHOURS.
+
+To sweep constant lap speeds: ` python simulator/trackEnv.py `
+'''
+
+import numpy as np
+import pandas as pd
+import json
+import sys, os
+from datetime import datetime
+
+dir = os.path.dirname(__file__)
+sys.path.insert(0, dir+'/../')   #allow imports from parent directory "onboarding22"
+
+from simulator.raceEnv import motor_power
+from util import *
+import forecast.clearsky
+
+TRACK_CSV = os.path.dirname(__file__) + '/../analysis/data/datalogger_fsgp2022_day1/heartland_track.csv'
+FSGP2022_DAYS = [datetime(2022, 7, 5), datetime(2022, 7, 6), datetime(2022, 7, 7)]
+
+CHARGE_START_HOUR = 7   #battery taken out of impound
+DRIVE_START_HOUR = 9    #track opens
+DRIVE_STOP_HOUR = 17    #track closes, laps finished after this don't count
+CHARGE_STOP_HOUR = 20   #battery put into impound
+
+MAX_STINT_HOURS = 2         #longest a driver can drive before swapping
+DRIVER_SWAP_MINUTES = 5     #time in the pits to swap drivers
+RESTART_WATTHOURS = 500     #charge in the pits to this after running out on track
+
+SUN_STEP = 60       #seconds between sun table entries
+
+
+class Track():
+    '''
+    A closed circuit as tables over segments step meters long along one lap: altitude, sin of the slope and heading at the start of each.
+    Sun tables of a day are computed once at the track's location and cached. Look things up at any distance with segment(dists).
+    '''
+
+    def __init__(self, dists, altitudes, latitudes, longitudes, lap_length, step=10., name="track"):
+        self.name = name
+        self.lap_length = lap_length
+        n = int(np.ceil(lap_length / step))
+        self.starts = np.linspace(0, lap_length, n + 1)[:-1]
+        self.lengths = np.full(n, lap_length / n)
+        self.latitude = np.mean(latitudes)
+        self.longitude = np.mean(longitudes)
+
+        self.altitudes = np.interp(self.starts, dists, altitudes, period=lap_length)
+        self.sinslopes = (np.roll(self.altitudes, -1) - self.altitudes) / self.lengths
+        lats = np.interp(self.starts, dists, latitudes, period=lap_length)
+        lons = np.interp(self.starts, dists, longitudes, period=lap_length)
+        self.headings = bearing(lats, lons, np.roll(lats, -1), np.roll(lons, -1))
+        self.sun_days = {}
+
+    @staticmethod
+    def from_csv(path=TRACK_CSV, lap_length=None, step=10., altitude_column="elev_usgs"):
+        '''
+        Track from a csv of points around one lap with dist (m), latitude, longitude and altitude columns, like heartland_track.csv.
+        The lap length defaults to the distance to the last point plus the distance from it back to the first.
+        '''
+        df = pd.read_csv(path)
+        lats, lons, dists = df['latitude'].to_numpy(), df['longitude'].to_numpy(), df['dist'].to_numpy()
+        if lap_length is None:
+            lap_length = dists[-1] + haversine(lats[-1], lons[-1], lats[0], lons[0])
+        return Track(dists, df[altitude_column].to_numpy(), lats, lons, lap_length, step, os.path.basename(path).split('.')[0])
+
+    def segment(self, dists):
+        '''Index of the segment at distances (m) since the start of any lap'''
+        return (np.asarray(dists) % self.lap_length // self.lengths[0]).astype(int) % len(self.starts)
+
+    def sun(self, day:datetime):
+        '''
+        Clear sky tables of a day from CHARGE_START_HOUR to CHARGE_STOP_HOUR: (times, sun_flat, sun_tilt,
+        and the cumulative energy per m^2 (J) of each since the first time), made once per day.
+        '''
+        key = day.date()
+        if key not in self.sun_days:
+            first = datetime(day.year, day.month, day.day, CHARGE_START_HOUR).timestamp()
+            last = datetime(day.year, day.month, day.day, CHARGE_STOP_HOUR).timestamp()
+            times = np.arange(first, last + SUN_STEP, SUN_STEP)
+            flat, tilt = forecast.clearsky.get_sun(self.latitude, self.longitude, times)
+            cumulative = lambda sun: np.concatenate([[0], np.cumsum((sun[1:] + sun[:-1]) / 2 * SUN_STEP)])
+            self.sun_days[key] = (times, flat, tilt, cumulative(flat), cumulative(tilt))
+        return self.sun_days[key]
+
+
+class TrackEnv():
+    '''
+    FSGP style track race. Call .step(target_mph) to drive one lap (plus any pit stop or end of day after it), or .run(strategy)
+    to drive every day. See the module docstring for the rules.
+
+        car: name of the car to simulate. Cars are stored as .json in the cars/ folder.
+        track: a Track, by default Heartland Motorsports Park from heartland_track.csv.
+        days: dates of the race days.
+        sun_multiplier: fraction of clear sky irradiance, for cloudy days.
+        wind: (speed m/s, direction it blows from in degrees) of a steady wind.
+        do_print: boolean of whether to print a summary of each day.
+    '''
+
+    def __init__(self, car="brizo_fsgp22", track=None, days=FSGP2022_DAYS, sun_multiplier=1., wind=(0., 0.), do_print=True):
+        cars_dir = os.path.dirname(__file__) + '/../cars'
+        with open(f"{cars_dir}/{car}.json", 'r') as props_json:
+            self.car_props = json.load(props_json)
+        self.track = track or Track.from_csv()
+        self.days = days
+        self.sun_multiplier = sun_multiplier
+        self.do_print = do_print
+
+        wind_speed, wind_direction = wind
+        self.headwinds = wind_speed * np.cos(np.radians(wind_direction - self.track.headings))
+        self.reset()
+
+    def printc(self, message):
+        if(self.do_print):
+            print(f"(TrackEnv) {message}")
+
+    def reset(self):
+        self.day_index = 0
+        self.energy = self.car_props['max_watthours']*3600     #joules left in battery
+        self.speed = 0                  #m/s at the start line
+        self.stint = 0                  #seconds driven by the current driver
+        self.laps_completed = 0
+        self.done = False
+
+        #one row per lap attempted: (day index, start time, end time, target mph, average mph, watthours at end, counted)
+        self.laps = []
+        self.start_day()
+
+    def start_day(self):
+        day = self.days[self.day_index]
+        self.time = datetime(day.year, day.month, day.day, CHARGE_START_HOUR).timestamp()
+        self.drive_stop = datetime(day.year, day.month, day.day, DRIVE_STOP_HOUR).timestamp()
+        self.charge(datetime(day.year, day.month, day.day, DRIVE_START_HOUR).timestamp(), tilted=True)
+        self.speed = 0
+        self.stint = 0
+
+    def end_day(self):
+        day = self.days[self.day_index]
+        self.charge(datetime(day.year, day.month, day.day, CHARGE_STOP_HOUR).timestamp(), tilted=True)
+        laps_today = sum(1 for lap in self.laps if lap[0] == self.day_index and lap[6])
+        self.printc(f"{day.strftime('%m/%d')}: {laps_today} laps, {round(self.energy/3600)}Wh left at impound")
+        self.day_index += 1
+        if self.day_index == len(self.days):
+            self.done = True
+        else:
+            self.start_day()
+
+    def charge(self, until, tilted=False):
+        '''Sit still with the array flat or tilted towards the sun from now until a unix time'''
+        until = max(until, self.time)
+        times, _, _, flat, tilt = self.track.sun(self.days[self.day_index])
+        cumulative = tilt if tilted else flat
+        gained = np.interp(until, times, cumulative) - np.interp(self.time, times, cumulative)
+        self.energy = min(self.energy + gained * self.sun_multiplier * self.car_props['array_multiplier'], self.car_props['max_watthours']*3600)
+        self.time = until
+
+    def drive_lap(self, target_mph):
+        '''
+        Drive one lap from the start line, accelerating or slowing at the car's max_accel/max_decel to the target speed.
+        Returns the time the lap ends, or None if the battery runs out (the car is then back in the pits).
+        '''
+        track = self.track
+        car = self.car_props
+        v_t = mph2mpersec(min(max(target_mph, car['min_mph']), car['max_mph']))
+
+        #speed at the end of each segment, reaching the target speed with constant acceleration
+        ends = np.cumsum(track.lengths)
+        if v_t >= self.speed:
+            v_end = np.minimum(np.sqrt(self.speed**2 + 2*car['max_accel']*ends), v_t)
+        else:
+            v_end = np.maximum(np.sqrt(np.maximum(self.speed**2 + 2*car['max_decel']*ends, 0)), v_t)
+        v_start = np.concatenate([[self.speed], v_end[:-1]])
+        v_avg = (v_start + v_end) / 2
+        dts = track.lengths / v_avg
+        accels = (v_end - v_start) / dts
+        starts = self.time + np.cumsum(dts) - dts
+
+        times, sun_flat, _, _, _ = track.sun(self.days[self.day_index])
+        array_powers = np.interp(starts, times, sun_flat) * self.sun_multiplier * car['array_multiplier']
+        motor_powers = np.clip(motor_power(car, accels, v_avg, self.headwinds, track.sinslopes), car['max_motor_input_power'], car['max_motor_output_power'])
+
+        #battery can't charge past full: energy = unclamped energy - the most it has ever been over capacity
+        max_energy = car['max_watthours']*3600
+        unclamped = self.energy + np.cumsum((array_powers - motor_powers) * dts)
+        energies = unclamped - np.maximum(np.maximum.accumulate(unclamped - max_energy), 0)
+
+        empty = np.flatnonzero(energies <= 0)
+        if len(empty):
+            #stopped on track: pushed back to the pits to charge
+            self.time = starts[empty[0]] + dts[empty[0]]
+            self.energy = 0
+            self.speed = 0
+            self.stint += self.time - starts[0]
+            self.charge_to(RESTART_WATTHOURS*3600)
+            return None
+
+        self.energy = energies[-1]
+        self.speed = v_end[-1]
+        self.stint += starts[-1] + dts[-1] - self.time
+        self.time = starts[-1] + dts[-1]
+        return self.time
+
+    def charge_to(self, energy):
+        '''Sit still with the array flat until the battery has energy (J), or the track closes'''
+        times, _, _, flat, _ = self.track.sun(self.days[self.day_index])
+        needed = (energy - self.energy) / (self.sun_multiplier * self.car_props['array_multiplier'])
+        target = np.interp(self.time, times, flat) + needed
+        until = np.interp(target, flat, times) if target <= flat[-1] else self.drive_stop
+        self.charge(min(until, self.drive_stop))
+
+    def step(self, target_mph):
+        '''Drive a lap at target_mph, then swap drivers if the next lap would go over MAX_STINT_HOURS, or end the day. Returns True when the race is over'''
+        if self.done:
+            return True
+
+        start = self.time
+        end = self.drive_lap(target_mph)
+        counted = end is not None and end <= self.drive_stop
+        self.laps_completed += counted
+        average_mph = meters2miles(self.track.lap_length) / ((end - start) / 3600) if end is not None else np.nan
+        self.laps.append((self.day_index, start, self.time, target_mph, average_mph, self.energy/3600, counted))
+
+        if self.time >= self.drive_stop:
+            self.end_day()
+        elif end is not None and self.stint + (end - start) > MAX_STINT_HOURS*3600:
+            self.speed = 0
+            self.charge(min(self.time + DRIVER_SWAP_MINUTES*60, self.drive_stop))
+            self.stint = 0
+            if self.time >= self.drive_stop:
+                self.end_day()
+        return self.done
+
+    def run(self, strategy):
+        '''
+        Drive every day. strategy is a constant target mph, a list of target mph for each lap (the last one repeats), or a function
+        that gets this env and returns the target mph of the next lap. Returns the number of laps completed.
+        '''
+        self.reset()
+        while not self.done:
+            if callable(strategy):
+                mph = strategy(self)
+            elif np.ndim(strategy) == 0:
+                mph = strategy
+            else:
+                mph = strategy[min(len(self.laps), len(strategy) - 1)]
+            self.step(mph)
+        return self.laps_completed
+
+    def get_laps(self):
+        '''DataFrame of every lap attempted, with local start and end times'''
+        laps = pd.DataFrame(self.laps, columns=['day', 'start', 'end', 'target_mph', 'average_mph', 'watthours', 'counted'])
+        laps['start'] = to_dates(laps['start']) if len(laps) else laps['start']
+        laps['end'] = to_dates(laps['end']) if len(laps) else laps['end']
+        return laps
+
+    def get_laps_completed(self):
+        '''Laps that count towards the score'''
+        return self.laps_completed
+
+    def get_watthours(self):
+        return self.energy / 3600.
+
+
+def sweep(mphs, **env_kwargs):
+    '''Laps completed and watthours left at the end when driving every lap at each of a list of constant speeds'''
+    env = TrackEnv(do_print=False, **env_kwargs)
+    results = []
+    for mph in mphs:
+        results.append({'mph': mph, 'laps': env.run(mph), 'watthours': env.get_watthours()})
+    return pd.DataFrame(results)
+
+
+def main():
+    import time
+    start = time.time()
+    results = sweep(range(20, 52, 2))
+    print(results.to_string(index=False))
+    print(f"{len(results)} strategies x {len(FSGP2022_DAYS)} days in {time.time() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
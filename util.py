@@ -46,6 +46,8 @@ def latlong_dist(origin, destination):
     return d
 
 def solar_altitude_angle(time_obj:datetime, latitude, longitude, tz_offset):
+    if isinstance(time_obj, datetime):
+        time_obj = time_obj.timetuple()
     day_of_year = time_obj.tm_yday
     Latitude = latitude * (2 * np.pi / 360)
 
@@ -67,6 +69,82 @@ def solar_altitude_angle(time_obj:datetime, latitude, longitude, tz_offset):
 
     return Solar_Altitude_Angle
 
+EARTH_RADIUS = 6371000.    #meters
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''vectorized haversine formula: earth surface distance (m) between arrays of lat/long (degrees). Inputs broadcast.'''
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def bearing(lat1, lon1, lat2, lon2):
+    '''vectorized initial bearing (degrees clockwise from north, 0-360) from lat/long 1 to lat/long 2. Inputs broadcast.'''
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    dlon = lon2 - lon1
+    y = np.sin(dlon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return np.degrees(np.arctan2(y, x)) % 360
+
+def along_track_dist(latitudes, longitudes):
+    '''cumulative distance (m) along a track of lat/longs, starting at 0. Works along the last axis.'''
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    steps = haversine(latitudes[..., :-1], longitudes[..., :-1], latitudes[..., 1:], longitudes[..., 1:])
+    dists = np.zeros(np.broadcast(latitudes, longitudes).shape)
+    np.cumsum(steps, axis=-1, out=dists[..., 1:])
+    return dists
+
+def solar_position(latitude, longitude, timestamps):
+    '''
+    Vectorized solar altitude and azimuth (radians, azimuth clockwise from north) for arrays of
+    latitude, longitude (degrees) and unix timestamps (seconds) or numpy datetime64 in UTC. Inputs broadcast,
+    so a (lat, lon) column against a row of times gives a grid. Uses the same approximations as solar_altitude_angle.
+    '''
+    seconds = np.asarray(timestamps)
+    if np.issubdtype(seconds.dtype, np.datetime64):
+        seconds = (seconds - np.datetime64(0, 's')) / np.timedelta64(1, 's')
+    days = np.floor_divide(seconds, 86400)
+    utc_hours = (seconds - days*86400) / 3600.
+    days = days.astype('datetime64[D]')
+    day_of_year = (days - days.astype('datetime64[Y]')).astype(float) + 1
+
+    B = np.radians((day_of_year - 81) * 360./365.)
+    E = 9.87*sin(2*B) - 7.53*cos(B) - 1.58*sin(B)                   #equation of time, minutes
+    solar_time = utc_hours + (4*np.asarray(longitude) + E) / 60.     #4 minutes per degree of longitude
+    hour_angle = np.radians((solar_time - 12) * 15)                  #negative in the morning
+    declination = np.radians(-23.45 * cos((day_of_year + 10) * 2*pi/365))
+    lat = np.radians(latitude)
+
+    altitude = np.arcsin(np.clip(sin(lat)*sin(declination) + cos(lat)*cos(declination)*cos(hour_angle), -1, 1))
+    azimuth = np.arctan2(-sin(hour_angle)*cos(declination), sin(declination)*cos(lat) - cos(declination)*sin(lat)*cos(hour_angle)) % (2*pi)
+    return altitude, azimuth
+
+class GridInterp():
+    '''
+    Bilinear interpolation of values on a regular grid, called like a LinearNDInterpolator: f(x, y).
+    x and y broadcast against each other. Points outside the grid take the value at the nearest edge.
+    values can have trailing dimensions (eg. stacked weather scenarios), which are appended to the output shape.
+    '''
+    def __init__(self, x0, dx, y0, dy, values):
+        self.x0 = x0
+        self.dx = dx
+        self.y0 = y0
+        self.dy = dy
+        self.values = np.asarray(values)
+        assert self.values.shape[0] >= 2 and self.values.shape[1] >= 2
+
+    def __call__(self, x, y):
+        nx, ny = self.values.shape[:2]
+        fx = np.clip((np.asarray(x, dtype=float) - self.x0) / self.dx, 0, nx - 1)
+        fy = np.clip((np.asarray(y, dtype=float) - self.y0) / self.dy, 0, ny - 1)
+        ix = np.minimum(fx.astype(int), nx - 2)
+        iy = np.minimum(fy.astype(int), ny - 2)
+        v = self.values
+        trailing = (1,) * (v.ndim - 2)
+        tx = (fx - ix).reshape(fx.shape + trailing)
+        ty = (fy - iy).reshape(fy.shape + trailing)
+        return (v[ix, iy]*(1-tx) + v[ix+1, iy]*tx)*(1-ty) + (v[ix, iy+1]*(1-tx) + v[ix+1, iy+1]*tx)*ty
+
 def print_dict(d, indent=0):
    for key, value in d.items():
         print('\t' * indent + str(key) + ':')
@@ -79,26 +157,71 @@ def ffill(x_0:list, y_0:list, epsilon=1e-6):
     '''
     Forward fill: Add points to a pair of lists so that the y value keeps constant until changed, creating steps instead of allowing graphs to interpolate
     '''
-    x = np.array(x_0).tolist()
-    y = np.array(y_0).tolist()
-    assert len(x) == len(y)
-    i = 1
-    while i < len(x):
-        x.insert(i, x[i]-epsilon)
-        y.insert(i, y[i-1])
-        i += 2
-    return np.array(x), np.array(y)
+    x_0 = np.asarray(x_0)
+    y_0 = np.asarray(y_0)
+    assert len(x_0) == len(y_0)
+    n = max(2*len(x_0) - 1, 0)
+    x = np.empty(n, dtype=np.result_type(x_0, float))
+    y = np.empty(n, dtype=y_0.dtype)
+    x[0::2] = x_0
+    x[1::2] = x_0[1:] - epsilon     #just before each change, y still has the last value
+    y[0::2] = y_0
+    y[1::2] = y_0[:-1]
+    return x, y
 
 def trim_to_range(x, y, left, right):
     '''trims x and y arrays so left < x < right'''
-    x = np.array(x)
-    y = np.array(y)
+    x = np.asarray(x)
+    y = np.asarray(y)
     l = bisect_left(x, left)
     r = bisect_left(x, right)
     x_trim = x[l:r]
     y_trim = y[l:r]
     return x_trim, y_trim
 
+def minmax_downsample(x, y, n_buckets):
+    '''
+    Downsample a line for plotting by keeping the lowest and highest point in each of n_buckets equal slices of x (sorted),
+    in their original order. With a bucket per pixel the plot looks the same as with every point. NaNs in y are dropped.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keep = ~np.isnan(y)
+    x, y = x[keep], y[keep]
+    if len(x) <= 2*n_buckets or x[-1] <= x[0]:
+        return x, y
+    buckets = np.minimum(((x - x[0]) / (x[-1] - x[0]) * n_buckets).astype(int), n_buckets - 1)
+    order = np.lexsort((y, buckets))                #by bucket, then by y
+    firsts = np.flatnonzero(np.diff(buckets[order], prepend=-1))
+    lasts = np.append(firsts[1:], len(order)) - 1
+    idx = np.unique(np.concatenate([order[firsts], order[lasts]]))
+    return x[idx], y[idx]
+
+def lttb(x, y, n_out):
+    '''
+    Largest triangle three buckets: downsample a line (x sorted) to n_out points that keep its shape, by picking the point in each
+    bucket that makes the biggest triangle with the point picked before it and the average of the next bucket.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)     #n_out-2 buckets between the first and last point, which are kept
+    counts = np.diff(edges)
+    next_x = np.append(np.add.reduceat(x[1:n-1], edges[:-1] - 1)[1:] / counts[1:], x[-1])
+    next_y = np.append(np.add.reduceat(y[1:n-1], edges[:-1] - 1)[1:] / counts[1:], y[-1])
+
+    chosen = np.empty(n_out, dtype=int)
+    chosen[0], chosen[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i+1]
+        areas = np.abs((x[a] - next_x[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[i] - y[a]))
+        a = lo + np.argmax(areas)
+        chosen[i+1] = a
+    return x[chosen], y[chosen]
+
 SUN_RED = np.array([227, 102, 42]) / 255
 SUN_YELLOW = np.array([255, 224, 0]) / 255
 NIGHT_GRAY = np.array([0, 0, 0]) / 255
@@ -118,6 +241,31 @@ def interp_color(vals, min_val, max_val, min_color, max_color):
 def moving_average(x, w):
     return np.convolve(x, np.ones(w), 'valid') / w
 
+class RingBuffer():
+    '''
+    The last n values of a history, kept without moving any when one is added: head is where the next value goes, so the
+    values oldest first are buffer[head:] then buffer[:head]. Keeps a running sum for the mean of the last n values.
+    '''
+    def __init__(self, n, fill=0.):
+        self.buffer = np.full(n, fill, dtype=float)
+        self.head = 0
+        self.sum = self.buffer.sum()
+
+    def push(self, value):
+        self.sum += value - self.buffer[self.head]
+        self.buffer[self.head] = value
+        self.head += 1
+        if self.head == len(self.buffer):
+            self.head = 0
+            self.sum = self.buffer.sum()    #so rounding errors in the running sum don't build up
+
+    def mean(self):
+        return self.sum / len(self.buffer)
+
+    def values(self):
+        '''All n values, oldest first'''
+        return np.concatenate((self.buffer[self.head:], self.buffer[:self.head]))
+
 def flatten_list(x):
     return np.concatenate(x).flat
 